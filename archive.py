@@ -0,0 +1,224 @@
+"""
+Compressed, seekable archives of the raw packet log.
+
+Once the LogWriter of server_log.txt rotates a segment (by size or age),
+the segment is archived in the background:
+    - its lines are grouped by IMEI (keeping the order of each device),
+    - cut into blocks of about BLOCK_BYTES of text,
+    - each block is compressed as a separate gzip member, so the archive
+      (<segment>.gz) is still a plain gzip file for zcat/zgrep,
+    - a sidecar index (<segment>.gz.idx, one JSON object per line) records
+      the offset and size of every block, with the time range and the
+      IMEIs of its lines.
+Looking up a device or a time range, or replaying an archive, only
+decompresses the blocks the index points to.
+
+Usage: python archive.py compress logs/server_log.txt.20200719-000000 [...]
+       python archive.py grep [--imei IMEI] [--start 'YYYY/MM/DD HH:MM:SS'] [--stop ...] logs/server_log.txt.*.gz
+"""
+
+import argparse
+import glob
+import json
+import os
+import queue
+import sys
+import threading
+import zlib
+
+import timestamps
+
+
+# Uncompressed bytes of log per compressed block
+BLOCK_BYTES = 1024 * 1024
+COMPRESSION_LEVEL = 6
+ARCHIVE_SUFFIX = '.gz'
+INDEX_SUFFIX = '.gz.idx'
+
+
+def compress_block(data):
+    """
+    One gzip member holding data.
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    return(compressor.compress(data) + compressor.flush())
+
+
+def decompress_members(data):
+    """
+    Decompressed content of consecutive gzip members (zlib.decompress() stops after the first).
+    """
+    parts = []
+    while (data):
+        decompressor = zlib.decompressobj(31)
+        parts.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return(b''.join(parts))
+
+
+def line_imei(line):
+    """
+    IMEI column of a log line (bytes): timestamp, IP, IMEI, IN/OUT, packet.
+    """
+    columns = line.split(b'\t', 3)
+    return(columns[2] if len(columns) > 3 else b'')
+
+
+def block_entry(offset, size, lines):
+    """
+    Index entry of a block of lines (bytes): position and size in the archive,
+    size of the text, number of lines, time range (epoch seconds, None if no
+    line has a timestamp) and IMEIs.
+    """
+    stamps = [line[:19].decode('ascii') for line in lines if line[19:20] == b'\t' and line[:19].isascii()]
+    times = timestamps.parse_local_array(stamps)
+    imeis = sorted(set(line_imei(line).decode('ascii', 'replace') for line in lines))
+    return({'offset': offset, 'size': size, 'text': sum(len(line) for line in lines), 'lines': len(lines),
+            'start': int(times.min()) if len(times) else None, 'stop': int(times.max()) if len(times) else None, 'imeis': imeis})
+
+
+def archive_segment(path, blockBytes=BLOCK_BYTES, remove=True):
+    """
+    Archive a rotated log segment into path.gz and its index path.gz.idx.
+    Both are written under temporary names and renamed once complete, so that
+    an interrupted archival leaves the segment untouched.
+    Returns the path of the archive.
+    """
+    with open(path, 'rb') as segment:
+        lines = [line if line.endswith(b'\n') else line + b'\n' for line in segment if line.strip()]
+    # Group the lines by device, keeping the order of each (sort is stable)
+    lines.sort(key=line_imei)
+
+    archivePath = path + ARCHIVE_SUFFIX
+    entries = []
+    offset = 0
+    with open(archivePath + '.tmp', 'wb') as archive:
+        block = []
+        size = 0
+        for line in lines + [None]:
+            if (block and (line is None or size + len(line) > blockBytes)):
+                data = compress_block(b''.join(block))
+                archive.write(data)
+                entries.append(block_entry(offset, len(data), block))
+                offset += len(data)
+                block = []
+                size = 0
+            if (line is not None):
+                block.append(line)
+                size += len(line)
+    with open(archivePath + '.idx.tmp', 'w') as index:
+        index.writelines(json.dumps(entry) + '\n' for entry in entries)
+    os.replace(archivePath + '.tmp', archivePath)
+    os.replace(archivePath + '.idx.tmp', path + INDEX_SUFFIX)
+    if (remove):
+        os.remove(path)
+    return(archivePath)
+
+
+def read_index(archivePath):
+    with open(archivePath[:-len(ARCHIVE_SUFFIX)] + INDEX_SUFFIX) as index:
+        return([json.loads(line) for line in index])
+
+
+def select_blocks(entries, imei=None, start=None, stop=None):
+    """
+    Index entries of the blocks that may hold lines of a device and/or a time range.
+    """
+    return([entry for entry in entries
+            if (imei is None or imei in entry['imeis'])
+            and (start is None or entry['stop'] is None or entry['stop'] >= start)
+            and (stop is None or entry['start'] is None or entry['start'] <= stop)])
+
+
+def read_block(archive, entry):
+    """
+    Decompressed lines (bytes) of one block, from an open archive file.
+    """
+    archive.seek(entry['offset'])
+    return(zlib.decompress(archive.read(entry['size']), 31).splitlines(True))
+
+
+def read_lines(archivePath, imei=None, start=None, stop=None):
+    """
+    Lines of an archive (as text) for a device and/or a time range (epoch seconds,
+    inclusive), decompressing only the blocks that may hold them.
+    """
+    imeiColumn = imei.encode('ascii') if imei is not None else None
+    with open(archivePath, 'rb') as archive:
+        for entry in select_blocks(read_index(archivePath), imei, start, stop):
+            for line in read_block(archive, entry):
+                if (imeiColumn is not None and line_imei(line) != imeiColumn):
+                    continue
+                if (start is not None or stop is not None):
+                    if (line[19:20] != b'\t'):
+                        continue
+                    lineTime = timestamps.parse_local(line[:19].decode('ascii'))
+                    if ((start is not None and lineTime < start) or (stop is not None and lineTime > stop)):
+                        continue
+                yield(line.decode('ascii'))
+
+
+def rotated_segments(path):
+    """
+    Rotated segments of a log that are not archived yet.
+    """
+    return(sorted(segment for segment in glob.glob(glob.escape(path) + '.*')
+                  if not segment.endswith((ARCHIVE_SUFFIX, INDEX_SUFFIX, '.tmp'))))
+
+
+class Archiver:
+    """
+    Archives rotated segments from a background thread, one at a time,
+    so that compression never delays the writing of logs.
+    """
+
+    def __init__(self, blockBytes=BLOCK_BYTES):
+        self.blockBytes = blockBytes
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='Archiver', daemon=True)
+        self.thread.start()
+
+    def submit(self, path):
+        self.queue.put(path)
+
+    def close(self):
+        """
+        Archive the segments submitted so far and stop the thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while (True):
+            path = self.queue.get()
+            if (path is None):
+                return
+            try:
+                archive_segment(path, self.blockBytes)
+            except (OSError, ValueError, IndexError) as e:
+                print('Could not archive', path, ':', repr(e))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compressed archives of the raw packet log')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    compress = subparsers.add_parser('compress', help='archive rotated log segments')
+    compress.add_argument('paths', nargs='+')
+    compress.add_argument('--keep', action='store_true', help='keep the text segments')
+    grep = subparsers.add_parser('grep', help='print the lines of a device and/or time range')
+    grep.add_argument('paths', nargs='+')
+    grep.add_argument('--imei')
+    grep.add_argument('--start', help="local time, 'YYYY/MM/DD HH:MM:SS'")
+    grep.add_argument('--stop', help="local time, 'YYYY/MM/DD HH:MM:SS'")
+    args = parser.parse_args()
+
+    if (args.command == 'compress'):
+        for path in args.paths:
+            size = os.path.getsize(path)
+            archivePath = archive_segment(path, remove=not args.keep)
+            print(path, '->', archivePath, '(%.1fx smaller)' % (size / max(os.path.getsize(archivePath), 1)))
+    elif (args.command == 'grep'):
+        start = timestamps.parse_local(args.start) if args.start else None
+        stop = timestamps.parse_local(args.stop) if args.stop else None
+        for path in args.paths:
+            sys.stdout.writelines(read_lines(path, args.imei, start, stop))
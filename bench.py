@@ -0,0 +1,283 @@
+"""
+Microbenchmarks for the tracking server hot path.
+
+Measures how many packets per second a single core can decode and answer,
+with the binary codec and with the former hex-string parser (kept below
+as a reference implementation, for comparison only), then with the cached
+response frames of responses.py.
+
+The overhead of logging is measured separately, as lines per second
+written through a LogWriter versus the former open/append/close per line.
+
+With --startup, the cold start of server.py (from launching the process
+to its port accepting connections) is measured instead, and checked
+against STARTUP_BUDGET: the exit status is 1 if the budget is exceeded.
+
+With --drain, the ceiling of the worker mode is measured instead: every
+log line and fix of every worker is written by a single drain thread of
+the parent process, so GPS packets per CPU-second of the parent bound the
+throughput of the whole server, whatever the number of workers.
+
+Usage: python bench.py [--packets N]
+       python bench.py --startup [--runs N]
+       python bench.py --drain [--packets N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+import codec
+import live
+import position_store
+import responses
+import trips
+import workers
+from logwriter import LogWriter
+
+
+# Sample frames, as sent by a zx303 device
+LOGIN_PACKET = bytes.fromhex('78780a010359339075469789010d0a')
+GPS_PACKET = (b'\x78\x78\x13\x10' + struct.pack('>6BBIIBH', 20, 7, 19, 14, 22, 22, 0xCF,
+              int(51.687534 * 1800000), int(21.847508 * 1800000), 0, 0x1400 | 154) + b'\x0d\x0a')
+STATUS_PACKET = bytes.fromhex('787807136401140100000d0a')
+TIME_PACKET = bytes.fromhex('787801300d0a')
+HEARTBEAT_PACKET = bytes.fromhex('787801080d0a')
+
+# Traffic mix of a device reporting its position every minute
+MIX = [GPS_PACKET] * 6 + [HEARTBEAT_PACKET, STATUS_PACKET, TIME_PACKET, LOGIN_PACKET]
+
+# A typical raw packet log line
+LOG_LINE = '2020/07/19 14:22:24\t127.0.0.1\t359339075469789\tIN\t' + GPS_PACKET.hex() + '\n'
+
+# Seconds server.py may take from launch to accepting connections
+STARTUP_BUDGET = 0.5
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+# Fixed response content, so that both paths do the same amount of work
+DATETIME_CONTENT = bytes.fromhex('14071308161e')
+
+
+def legacy_answer(packet):
+    """
+    Former parsing path: hexify the packet into a list of 2-char strings,
+    parse fields back with int(..., base=16) and build the response as a hex string.
+    """
+    packet_list = [packet.hex()[i:i+2] for i in range(4, len(packet.hex())-4, 2)]
+    protocol = packet_list[1]
+    if (protocol == '01'):
+        imei = ''.join(packet_list[2:10])[1:]
+        software_version = int(packet_list[10], base=16)
+        content = '01'
+    elif (protocol == '10' or protocol == '11'):
+        dt = ''.join([ format(int(x, base = 16), '02d') for x in packet_list[2:8] ])
+        nb_sat = int(packet_list[8][1], base=16)
+        latitude = int(''.join(packet_list[9:13]), base=16) / (30000 * 60)
+        longitude = int(''.join(packet_list[13:17]), base=16) / (30000 * 60)
+        speed = int(packet_list[17], base=16)
+        flags = format(int(''.join(packet_list[18:20]), base=16), '0>16b')
+        valid = flags[3]
+        if (flags[4] == '1'):
+            latitude = -latitude
+        if (flags[5] == '0'):
+            longitude = -longitude
+        heading = int(''.join(flags[6:]), base = 2)
+        content = DATETIME_CONTENT.hex().upper()
+    elif (protocol == '13'):
+        battery = int(packet_list[2], base=16)
+        content = None
+    else:
+        content = None
+    r = '7878' + format((len(bytes.fromhex(content)) if content else 0)+1, '02X') + protocol + (content if content else '') + '0D0A'
+    return(bytes.fromhex(r))
+
+
+def codec_answer(packet):
+    """
+    Binary codec path: decode fields from the raw bytes and encode
+    the response straight into a bytes buffer.
+    """
+    protocol, fields = codec.decode(packet)
+    if (protocol == 0x01):
+        return(codec.make_content_response(protocol, b'\x01'))
+    elif (protocol == 0x10 or protocol == 0x11):
+        return(codec.make_content_response(protocol, DATETIME_CONTENT))
+    return(codec.make_content_response(protocol))
+
+
+def cached_answer(packet):
+    """
+    Codec path with the prebuilt and per-second response frames of responses.py.
+    """
+    protocol, fields = codec.decode(packet)
+    if (protocol == 0x01):
+        return(responses.LOGIN_ACCEPTED)
+    elif (protocol in responses.DATETIME_PROTOCOLS):
+        return(responses.datetime_response(protocol))
+    return(responses.generic_response(protocol))
+
+
+def run_log(name, lines, directory):
+    """
+    Time the writing of lines to a log file, with the former open/append/close
+    per line, or with a LogWriter (including the final flush to disk).
+    """
+    path = os.path.join(directory, name + '.txt')
+    start = time.perf_counter()
+    if (name == 'legacy-log'):
+        for i in range(lines):
+            with open(path, 'a+') as log:
+                log.write(LOG_LINE)
+    else:
+        writer = LogWriter(path)
+        for i in range(lines):
+            writer.write(LOG_LINE)
+        writer.close()
+    elapsed = time.perf_counter() - start
+    rate = lines / elapsed
+    print('%-10s %10.0f lines/sec' % (name, rate))
+    return(rate)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return(sock.getsockname()[1])
+
+
+def measure_startup(runs):
+    """
+    Seconds from launching server.py to its port accepting a connection, for each run.
+    The server runs in a temporary directory, so that its logs and store are thrown away.
+    """
+    durations = []
+    for i in range(runs):
+        port = free_port()
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            server = subprocess.Popen([sys.executable, SERVER_SCRIPT, '--port', str(port)], cwd=directory,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                while (True):
+                    try:
+                        socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                        break
+                    except OSError:
+                        if (server.poll() is not None):
+                            raise RuntimeError('server.py exited with status %d' % server.returncode)
+                        time.sleep(0.002)
+                durations.append(time.perf_counter() - start)
+            finally:
+                server.terminate()
+                server.wait()
+    return(durations)
+
+
+def funnel_gps(queue, packets):
+    """
+    Producer process of measure_drain(): what a worker funnels for each GPS
+    packet (raw IN and OUT lines, location line, fix, live position, trip update),
+    in batches of FUNNEL_BATCH items.
+    """
+    imei = '359339075469789'
+    location = '2020/07/19 14:22:24\t127.0.0.1\t' + imei + '\tGPS\t2020/07/19 14:22:22\t1\t15\t51.687534\t21.847508\t0.0\t0\t154\n'
+    items = []
+    for i in range(packets):
+        fixTime = 1595168542 + i
+        items += [('log', ('server_log.txt', LOG_LINE)),
+                  ('log', ('server_log.txt', LOG_LINE.replace('IN', 'OUT'))),
+                  ('log', ('location_log.txt', location)),
+                  ('fix', (imei, fixTime, fixTime, 51.687534, 21.847508, 0, 154, 15, 1)),
+                  ('live', (imei, {'method': 'GPS', 'datetime': fixTime, 'valid': 1, 'nb_sat': 15, 'latitude': 51.687534,
+                                   'longitude': 21.847508, 'accuracy': 0.0, 'speed': 0, 'heading': 154})),
+                  ('trip', (imei, fixTime, 51.687534, 21.847508))]
+        if (len(items) >= workers.FUNNEL_BATCH):
+            queue.put(items)
+            items = []
+    queue.put(items)
+    queue.put(None)
+    queue.close()
+    queue.join_thread()
+
+
+def measure_drain(packets, directory):
+    """
+    GPS packets per CPU-second of the parent process in worker mode: a forked
+    producer funnels packets as a worker does, and workers.drain() writes them
+    to log files and a position store in directory (CPU time of the producer,
+    i.e. of the workers, is not counted).
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    producer = context.Process(target=funnel_gps, args=(queue, packets))
+    producer.start()
+    logs = {}
+    def log_writer(filename):
+        if (filename not in logs):
+            logs[filename] = LogWriter(os.path.join(directory, filename))
+        return(logs[filename])
+    store = position_store.PositionStore(os.path.join(directory, 'positions'))
+    start = time.process_time()
+    workers.drain(queue, log_writer, store, live.LiveTable(), trips.TripTracker(), None)
+    store.close()
+    for writer in logs.values():
+        writer.close()
+    elapsed = time.process_time() - start
+    producer.join()
+    return(packets / elapsed)
+
+
+def run(name, function, packets):
+    """
+    Time function over the packets and print the packets/sec rate.
+    """
+    start = time.perf_counter()
+    for packet in packets:
+        function(packet)
+    elapsed = time.perf_counter() - start
+    rate = len(packets) / elapsed
+    print('%-10s %10.0f packets/sec' % (name, rate))
+    return(rate)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tracking server microbenchmarks')
+    parser.add_argument('--packets', type=int, default=200000, help='number of packets per run')
+    parser.add_argument('--lines', type=int, default=50000, help='number of log lines per run')
+    parser.add_argument('--startup', action='store_true', help='measure the cold start of server.py against STARTUP_BUDGET')
+    parser.add_argument('--runs', type=int, default=5, help='number of server launches (with --startup)')
+    parser.add_argument('--drain', action='store_true', help='measure the ceiling of the worker mode, set by the drain thread of the parent')
+    args = parser.parse_args()
+
+    if (args.drain):
+        with tempfile.TemporaryDirectory() as directory:
+            print('drain      %10.0f GPS packets/sec per CPU-second of the parent' % measure_drain(args.packets, directory))
+        sys.exit(0)
+
+    if (args.startup):
+        durations = sorted(measure_startup(args.runs))
+        median = durations[len(durations) // 2]
+        print('startup    %10.0f ms median, %.0f ms max (budget %.0f ms)' % (median * 1000, durations[-1] * 1000, STARTUP_BUDGET * 1000))
+        sys.exit(0 if median <= STARTUP_BUDGET else 1)
+
+    # Both paths must agree before being compared
+    for packet in MIX:
+        assert legacy_answer(packet) == codec_answer(packet), packet.hex()
+
+    packets = (MIX * (args.packets // len(MIX) + 1))[:args.packets]
+    legacy = run('legacy', legacy_answer, packets)
+    binary = run('codec', codec_answer, packets)
+    print('speedup    %10.1fx' % (binary / legacy))
+    cached = run('cached', cached_answer, packets)
+    print('speedup    %10.1fx (over codec)' % (cached / binary))
+
+    with tempfile.TemporaryDirectory() as directory:
+        legacy = run_log('legacy-log', args.lines, directory)
+        buffered = run_log('logwriter', args.lines, directory)
+    print('speedup    %10.1fx' % (buffered / legacy))
@@ -0,0 +1,279 @@
+"""
+Binary codec for the zx303 protocol.
+
+Incoming frames are decoded straight from the raw bytes (through memoryview
+and precompiled struct.Struct objects) instead of going through hex strings,
+and responses are encoded directly into bytes buffers.
+
+A frame looks like: 0x78 0x78 LENGTH PROTOCOL CONTENT... 0x0D 0x0A
+where LENGTH counts the protocol byte and the content.
+"""
+
+import struct
+
+
+# Declare common bytes for packets
+START = b'\x78\x78'
+STOP = b'\x0d\x0a'
+
+# Offsets inside a frame
+LENGTH_OFFSET = 2
+PROTOCOL_OFFSET = 3
+CONTENT_OFFSET = 4
+
+protocol_dict = {
+    'protocol': {
+        '01': 'login',
+        '05': 'supervision',
+        '08': 'heartbeat',
+        '10': 'gps_positioning',
+        '11': 'gps_offline_positioning',
+        '13': 'status',
+        '14': 'hibernation',
+        '15': 'reset',
+        '16': 'whitelist_total',
+        '17': 'wifi_offline_positioning',
+        '30': 'time',
+        '43': 'mom_phone_WTFISDIS?',
+        '56': 'stop_alarm',
+        '57': 'setup',
+        '58': 'synchronous_whitelist',
+        '67': 'restore_password',
+        '69': 'wifi_positioning',
+        '80': 'manual_positioning',
+        '81': 'battery_charge',
+        '82': 'charger_connected',
+        '83': 'charger_disconnected',
+        '94': 'vibration_received',
+        '98': 'position_upload_interval'
+    },
+    'response_method': {
+        'login': 'login',
+        'logout': 'logout',
+        'supervision': '',
+        'heartbeat': '',
+        'gps_positioning': 'datetime_response',
+        'gps_offline_positioning': 'datetime_response',
+        'status': '',
+        'hibernation': '',
+        'reset': '',
+        'whitelist_total': '',
+        'wifi_offline_positioning': 'datetime_position_response',
+        'time': 'time_response',
+        'stop_alarm': '',
+        'setup': 'setup',
+        'synchronous_whitelist': '',
+        'restore_password': '',
+        'wifi_positioning': 'datetime_position_response',
+        'manual_positioning': '',
+        'battery_charge': '',
+        'charger_connected': '',
+        'charger_disconnected': '',
+        'vibration_received': '',
+        'position_upload_interval': 'upload_interval_response'
+    }
+}
+
+# Same table keyed by the protocol byte, for lookups on raw frames
+protocol_names = {int(k, base=16): v for k, v in protocol_dict['protocol'].items()}
+
+
+# Precompiled layouts of the frame contents
+LOGIN = struct.Struct('>8sB')
+# YY MM DD HH MM SS, length/satellites nibbles, latitude, longitude, speed, flags
+GPS = struct.Struct('>6BBIIBH')
+STATUS = struct.Struct('>3B')
+STATUS_SIGNAL = struct.Struct('>4B')
+UPLOAD_INTERVAL = struct.Struct('>2s')
+HEADER = struct.Struct('>2sBB')
+DATETIME_SHORT = struct.Struct('>6B')
+DATETIME_LONG = struct.Struct('>H5B')
+SETUP = struct.Struct('>HB3s3s3sB3s3s3sBHH')
+
+# Latitude and longitude were multiplied by 30000 after being
+# converted to seconds-of-angle
+GPS_COORDINATE_DIVISOR = 30000 * 60
+
+# Size of a GPS frame without any optional field: header, GPS content, stop bytes
+GPS_FRAME_SIZE = HEADER.size + GPS.size + len(STOP)
+# Same layout as a whole GPS frame, for NumPy (see decode_gps_array)
+GPS_FRAME_FIELDS = [
+    ('start', 'V2'),
+    ('length', 'u1'),
+    ('protocol', 'u1'),
+    ('datetime', 'u1', (6,)),
+    ('sat', 'u1'),
+    ('latitude', '>u4'),
+    ('longitude', '>u4'),
+    ('speed', 'u1'),
+    ('flags', '>u2'),
+    ('stop', 'V2')
+]
+
+
+def decode_login(frame):
+    """
+    Login content: 8 bytes of BCD IMEI (with a leading 0 nibble)
+    followed by the software version.
+    Returns (imei, software_version).
+    """
+    imei, software_version = LOGIN.unpack_from(frame, CONTENT_OFFSET)
+    return((imei.hex()[1:], software_version))
+
+
+def decode_gps(frame):
+    """
+    GPS content for protocols 0x10 and 0x11, which share the exact same layout.
+    Returns (datetime_fields, nb_sat, latitude, longitude, speed, valid, heading)
+    where datetime_fields is the (YY, MM, DD, HH, MM, SS) tuple sent by the device, in UTC.
+    """
+    yy, mo, dd, hh, mi, ss, sat, lat, lon, speed, flags = GPS.unpack_from(frame, CONTENT_OFFSET)
+    # Low nibble of the satellite byte is the number of satellites
+    nb_sat = sat & 0x0F
+    latitude = lat / GPS_COORDINATE_DIVISOR
+    longitude = lon / GPS_COORDINATE_DIVISOR
+    # Flags, from the most significant bit: 3 = positioned, 4 = south, 5 = east
+    valid = (flags >> 12) & 1
+    if (flags & 0x0800):
+        latitude = -latitude
+    if not (flags & 0x0400):
+        longitude = -longitude
+    heading = flags & 0x03FF
+    return(((yy, mo, dd, hh, mi, ss), nb_sat, latitude, longitude, speed, valid, heading))
+
+
+def decode_gps_array(frames):
+    """
+    Vectorized decode_gps over consecutive GPS frames of exactly GPS_FRAME_SIZE bytes
+    (e.g. a backlog of offline positions). Returns the same fields as decode_gps,
+    as NumPy arrays: datetime_fields has one (YY, MM, DD, HH, MM, SS) row per frame.
+    """
+    import numpy as np
+    raw = np.frombuffer(frames, dtype=np.dtype(GPS_FRAME_FIELDS))
+    flags = raw['flags'].astype(np.int64)
+    latitude = raw['latitude'] / GPS_COORDINATE_DIVISOR
+    longitude = raw['longitude'] / GPS_COORDINATE_DIVISOR
+    latitude = np.where(flags & 0x0800, -latitude, latitude)
+    longitude = np.where(flags & 0x0400, longitude, -longitude)
+    return((raw['datetime'], raw['sat'] & 0x0F, latitude, longitude, raw['speed'], (flags >> 12) & 1, flags & 0x03FF))
+
+
+def decode_status(frame):
+    """
+    Status content: battery, software version, status upload interval
+    and, on longer frames, signal strength (None otherwise).
+    """
+    if (frame[LENGTH_OFFSET] >= 0x07):
+        return(STATUS_SIGNAL.unpack_from(frame, CONTENT_OFFSET))
+    return(STATUS.unpack_from(frame, CONTENT_OFFSET) + (None,))
+
+
+def decode_upload_interval(frame):
+    """
+    Upload interval content: the new interval, kept as raw bytes
+    because it is echoed back as is.
+    """
+    return(UPLOAD_INTERVAL.unpack_from(frame, CONTENT_OFFSET))
+
+
+# Decoders by protocol byte; protocols without content are not listed
+decoders = {
+    0x01: decode_login,
+    0x10: decode_gps,
+    0x11: decode_gps,
+    0x13: decode_status,
+    0x98: decode_upload_interval,
+}
+
+
+def decode(packet):
+    """
+    Decode one complete frame without copying it.
+    Returns (protocol, fields) where fields is None for protocols
+    that have no registered decoder.
+    """
+    frame = memoryview(packet)
+    protocol = frame[PROTOCOL_OFFSET]
+    decoder = decoders.get(protocol)
+    return((protocol, decoder(frame) if decoder else None))
+
+
+def make_content_response(protocol, content=b''):
+    """
+    Encode a response of the format start-start-length-protocol-content-stop_1-stop_2
+    in a single preallocated buffer.
+    """
+    size = len(content)
+    buffer = bytearray(HEADER.size + size + 2)
+    HEADER.pack_into(buffer, 0, START, size + 1, protocol)
+    buffer[CONTENT_OFFSET:CONTENT_OFFSET + size] = content
+    buffer[-2:] = STOP
+    return(bytes(buffer))
+
+
+def encode_datetime(dt, truncatedYear):
+    """
+    Encode a datetime as YY YY MM DD HH MM SS if truncatedYear is False,
+    or as YY MM DD HH MM SS if truncatedYear is True.
+    """
+    if (truncatedYear):
+        return(DATETIME_SHORT.pack(dt.year % 100, dt.month, dt.day, dt.hour, dt.minute, dt.second))
+    return(DATETIME_LONG.pack(dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second))
+
+
+def encode_setup(uploadIntervalSeconds, binarySwitch, alarms, dndTimeSwitch, dndTimes, gpsTimeSwitch, gpsTimeStart, gpsTimeStop, phoneNumbers):
+    """
+    Encode the content of a setup response.
+    Alarms and DND times are 3 raw bytes each, and phone numbers are sent
+    in ASCII, separated by ';'.
+    """
+    return(SETUP.pack(uploadIntervalSeconds, binarySwitch, *alarms, dndTimeSwitch, *dndTimes, gpsTimeSwitch, gpsTimeStart, gpsTimeStop)
+           + b';'.join(n.encode('ascii') for n in phoneNumbers))
+
+
+class FrameBuffer:
+    """
+    Incremental reassembly of frames from a TCP stream.
+    A single read can hold several coalesced frames (e.g. when a device
+    flushes its offline backlog) as well as the beginning of a frame whose
+    end will only come with the next read: feed() returns every complete
+    frame and keeps the remainder for the next call.
+    """
+    __slots__ = ('buffer',)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Append freshly read bytes and return the list of complete frames.
+        Bytes that cannot be the start of a frame are discarded, so that
+        the stream resynchronizes on the next 0x78 0x78 marker.
+        """
+        buffer = self.buffer
+        buffer += data
+        end = len(buffer)
+        frames = []
+        position = 0
+        while (True):
+            start = buffer.find(START, position)
+            if (start < 0):
+                # Keep a trailing 0x78 that may be the first half of a start marker
+                position = end - 1 if (end > position and buffer[-1] == START[0]) else end
+                break
+            # Wait for the length byte, then for the whole frame
+            if (end - start <= LENGTH_OFFSET):
+                position = start
+                break
+            size = buffer[start + LENGTH_OFFSET] + len(START) + 1 + len(STOP)
+            if (end - start < size):
+                position = start
+                break
+            # A start marker inside garbage: skip it and look for the next one
+            if (buffer[start + size - len(STOP):start + size] != STOP):
+                position = start + 1
+                continue
+            frames.append(bytes(buffer[start:start + size]))
+            position = start + size
+        del buffer[:position]
+        return(frames)
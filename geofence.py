@@ -0,0 +1,199 @@
+"""
+Geofences: depots and regions that trackers enter and leave.
+
+Fences are circles (center and radius in metres) or polygons (with holes,
+lon/lat treated as planar, which is fine at the scale of a region), loaded
+from a GeoJSON FeatureCollection:
+    - Polygon / MultiPolygon features are polygon fences,
+    - Point features with a "radius" property (metres) are circle fences,
+named after their "name" property.
+
+They are kept in a hierarchical grid: each fence is registered, at the
+level whose cell size fits its bounding box, in the few (at most 4) cells
+it overlaps. Looking up a fix reads one cell per level in use, then only
+tests the fences of those cells, so the cost of a fix does not depend on
+the number of fences, but on the number of fences around it.
+
+The engine keeps, per device, the set of fences it is inside, and reports
+only transitions: ENTER when a fix falls in a new fence, EXIT when it is
+no longer in one.
+"""
+
+import json
+import math
+import threading
+
+
+# Cell size (degrees) of the finest grid level, about 1 km
+BASE_CELL = 0.01
+# Mean Earth radius, in metres
+EARTH_RADIUS = 6371008.8
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in metres between two points given in degrees.
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return(2 * EARTH_RADIUS * math.asin(math.sqrt(a)))
+
+
+def ring_contains(ring, lat, lon):
+    """
+    Ray casting test of a point against a closed ring of (lon, lat) points.
+    """
+    inside = False
+    x1, y1 = ring[-1]
+    for x2, y2 in ring:
+        if ((y1 > lat) != (y2 > lat)) and (lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1):
+            inside = not inside
+        x1, y1 = x2, y2
+    return(inside)
+
+
+class CircleFence:
+    """
+    Every point within radius metres of a center.
+    """
+    __slots__ = ('name', 'latitude', 'longitude', 'radius', 'bbox')
+
+    def __init__(self, name, latitude, longitude, radius):
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius
+        dLat = radius / METRES_PER_DEGREE
+        dLon = dLat / max(math.cos(math.radians(latitude)), 1e-6)
+        self.bbox = (latitude - dLat, longitude - dLon, latitude + dLat, longitude + dLon)
+
+    def contains(self, lat, lon):
+        return(haversine(self.latitude, self.longitude, lat, lon) <= self.radius)
+
+
+class PolygonFence:
+    """
+    One or more polygons, each an outer ring and optional holes,
+    as lists of (lon, lat) points (the GeoJSON order).
+    """
+    __slots__ = ('name', 'polygons', 'bbox')
+
+    def __init__(self, name, polygons):
+        self.name = name
+        self.polygons = [[[tuple(point[:2]) for point in ring] for ring in polygon] for polygon in polygons]
+        lons = [point[0] for polygon in self.polygons for point in polygon[0]]
+        lats = [point[1] for polygon in self.polygons for point in polygon[0]]
+        self.bbox = (min(lats), min(lons), max(lats), max(lons))
+
+    def contains(self, lat, lon):
+        for outer, *holes in self.polygons:
+            if (ring_contains(outer, lat, lon) and not any(ring_contains(hole, lat, lon) for hole in holes)):
+                return(True)
+        return(False)
+
+
+class FenceIndex:
+    """
+    Hierarchical grid of fences. Level L has cells of BASE_CELL * 2**L degrees.
+    """
+
+    def __init__(self, fences=()):
+        self.cells = {}
+        self.levels = set()
+        self.count = 0
+        for fence in fences:
+            self.add(fence)
+
+    def add(self, fence):
+        south, west, north, east = fence.bbox
+        # Smallest level at which the bounding box spans at most 2 cells each way
+        level = 0
+        while (max(north - south, east - west) > BASE_CELL * 2 ** level):
+            level += 1
+        size = BASE_CELL * 2 ** level
+        for i in range(math.floor(south / size), math.floor(north / size) + 1):
+            for j in range(math.floor(west / size), math.floor(east / size) + 1):
+                self.cells.setdefault((level, i, j), []).append(fence)
+        self.levels.add(level)
+        self.count += 1
+
+    def candidates(self, lat, lon):
+        """
+        Fences whose cells hold the point.
+        """
+        found = []
+        for level in self.levels:
+            size = BASE_CELL * 2 ** level
+            fences = self.cells.get((level, math.floor(lat / size), math.floor(lon / size)))
+            if (fences):
+                found.extend(fences)
+        return(found)
+
+    def containing(self, lat, lon):
+        """
+        Names of the fences that contain the point: candidates are first
+        filtered on their bounding box, which is much cheaper than contains().
+        """
+        names = []
+        for fence in self.candidates(lat, lon):
+            south, west, north, east = fence.bbox
+            if (south <= lat <= north and west <= lon <= east and fence.contains(lat, lon)):
+                names.append(fence.name)
+        return(frozenset(names))
+
+
+class GeofenceEngine:
+    """
+    Fence index plus the fences each device is currently inside.
+    """
+
+    def __init__(self, fences=()):
+        self.index = FenceIndex(fences)
+        self.inside = {}
+        self.lock = threading.Lock()
+
+    def update(self, imei, lat, lon):
+        """
+        Evaluate a new fix of a device, and return its transitions
+        as a list of ('ENTER' or 'EXIT', fence name).
+        """
+        current = self.index.containing(lat, lon)
+        with self.lock:
+            previous = self.inside.get(imei, frozenset())
+            if (current == previous):
+                return([])
+            # Devices outside every fence take no room
+            if (current):
+                self.inside[imei] = current
+            else:
+                del self.inside[imei]
+        return([('EXIT', name) for name in sorted(previous - current)] + [('ENTER', name) for name in sorted(current - previous)])
+
+    def __len__(self):
+        return(self.index.count)
+
+
+def fences_from_geojson(data):
+    """
+    Fences of a GeoJSON FeatureCollection (see the module docstring).
+    """
+    fences = []
+    for number, feature in enumerate(data.get('features', [])):
+        geometry = feature.get('geometry') or {}
+        properties = feature.get('properties') or {}
+        name = str(properties.get('name', 'fence-%d' % number))
+        if (geometry.get('type') == 'Polygon'):
+            fences.append(PolygonFence(name, [geometry['coordinates']]))
+        elif (geometry.get('type') == 'MultiPolygon'):
+            fences.append(PolygonFence(name, geometry['coordinates']))
+        elif (geometry.get('type') == 'Point' and 'radius' in properties):
+            lon, lat = geometry['coordinates'][:2]
+            fences.append(CircleFence(name, lat, lon, float(properties['radius'])))
+    return(fences)
+
+
+def load_fences(path):
+    with open(path) as geojson:
+        return(fences_from_geojson(json.load(geojson)))
@@ -0,0 +1,104 @@
+"""
+Grid aggregation of fixes for fleet-wide overview maps.
+
+Instead of one marker per fix, fixes are counted in a fixed grid of square
+cells (in degrees), keeping the number of fixes and the centroid of each
+non-empty cell. The aggregated grid is cached on disk along with the number
+of records already folded in for each device, so that later renders only
+read and fold the fixes appended to the position store since then.
+"""
+
+import os
+
+import numpy as np
+
+import position_store
+
+
+# Cell size in degrees (about 100 m of latitude)
+DEFAULT_CELL = 0.001
+# Where the aggregated grid is cached
+DEFAULT_CACHE = './logs/grid_cache.npz'
+
+
+class GridAggregate:
+    """
+    Sparse grid: sorted cell keys with, for each cell, the number of fixes
+    and the sums of their latitudes and longitudes.
+    """
+
+    def __init__(self, cell=DEFAULT_CELL):
+        self.cell = cell
+        self.columns = int(np.ceil(360.0 / cell)) + 1
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.latSums = np.empty(0, dtype=np.float64)
+        self.lonSums = np.empty(0, dtype=np.float64)
+        # Number of records of each device already aggregated
+        self.offsets = {}
+
+    def add(self, latitude, longitude):
+        """
+        Fold new fixes into the grid.
+        """
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        if (len(latitude) == 0):
+            return
+        rows = np.floor((latitude + 90.0) / self.cell).astype(np.int64)
+        columns = np.floor((longitude + 180.0) / self.cell).astype(np.int64)
+        keys = np.concatenate((self.keys, rows * self.columns + columns))
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.concatenate((self.counts, np.ones(len(latitude), dtype=np.int64)))
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(self.keys)).astype(np.int64)
+        self.latSums = np.bincount(inverse, weights=np.concatenate((self.latSums, latitude)), minlength=len(self.keys))
+        self.lonSums = np.bincount(inverse, weights=np.concatenate((self.lonSums, longitude)), minlength=len(self.keys))
+
+    def update(self, directory=position_store.DEFAULT_DIRECTORY):
+        """
+        Fold the fixes appended to the position store since the last update.
+        Returns the number of new fixes.
+        """
+        added = 0
+        for imei in position_store.devices(directory):
+            records, self.offsets[imei] = position_store.tail(directory, imei, self.offsets.get(imei, 0))
+            self.add(records['latitude'], records['longitude'])
+            added += len(records)
+        return(added)
+
+    def cells(self):
+        """
+        Centroid latitudes, centroid longitudes and fix counts of the non-empty cells.
+        """
+        return((self.latSums / self.counts, self.lonSums / self.counts, self.counts))
+
+    def save(self, path):
+        np.savez(path, cell=self.cell, keys=self.keys, counts=self.counts, latSums=self.latSums, lonSums=self.lonSums,
+                 imeis=np.array(list(self.offsets.keys()), dtype=str), offsets=np.array(list(self.offsets.values()), dtype=np.int64))
+
+
+def load_grid(path=DEFAULT_CACHE, cell=DEFAULT_CELL):
+    """
+    Load the cached grid, or start an empty one if there is no cache
+    or if it was built with another cell size.
+    """
+    grid = GridAggregate(cell)
+    if (os.path.exists(path)):
+        with np.load(path) as cache:
+            if (float(cache['cell']) == cell):
+                grid.keys = cache['keys']
+                grid.counts = cache['counts']
+                grid.latSums = cache['latSums']
+                grid.lonSums = cache['lonSums']
+                grid.offsets = dict(zip(cache['imeis'].tolist(), cache['offsets'].tolist()))
+    return(grid)
+
+
+def updated_grid(path=DEFAULT_CACHE, cell=DEFAULT_CELL, directory=position_store.DEFAULT_DIRECTORY):
+    """
+    Load the cached grid, fold the new fixes and save it back.
+    """
+    grid = load_grid(path, cell)
+    if (grid.update(directory) or not os.path.exists(path)):
+        grid.save(path)
+    return(grid)
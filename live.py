@@ -0,0 +1,178 @@
+"""
+Live positions over HTTP.
+
+The server publishes every decoded fix into an in-memory table keyed by
+IMEI, and a small local HTTP server exposes it without any file I/O:
+    GET /positions          latest fix of every device (JSON)
+    GET /positions/<imei>   latest fix of one device (JSON)
+    GET /events[?imei=...]  Server-Sent Events stream of new fixes
+    GET /metrics            server metrics, in the Prometheus text format
+    GET /trips              odometer, state and last trips of every device (JSON)
+    GET /trips/<imei>       the same, for one device
+"""
+
+from urllib.parse import parse_qs, urlparse
+import http.server
+import json
+import queue
+import socketserver
+import threading
+
+import timestamps
+
+
+# Fixes queued for a slow SSE client before it starts missing some
+SUBSCRIBER_QUEUE_SIZE = 1000
+# Seconds between keep-alive comments on idle SSE streams
+KEEPALIVE_INTERVAL = 15
+
+
+class LiveTable:
+    """
+    Latest fix per IMEI, plus the queues of the SSE subscribers.
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.fixes = {}
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def publish(self, imei, fix):
+        """
+        Record the latest fix of a device and forward it to the subscribers.
+        Subscribers that cannot keep up lose fixes rather than slowing the server down.
+        """
+        fix = dict(fix, imei=imei)
+        with self.lock:
+            self.fixes[imei] = fix
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(fix)
+            except queue.Full:
+                pass
+
+    def latest(self, imei=None):
+        """
+        Latest fix of one device (None if unknown), or of every device.
+        """
+        with self.lock:
+            if (imei is None):
+                return(list(self.fixes.values()))
+            return(self.fixes.get(imei))
+
+    def subscribe(self):
+        subscriber = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return(subscriber)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+
+def fix_json(fix):
+    """
+    JSON of a fix, with its datetime (epoch seconds) formatted to local time.
+    """
+    if (fix.get('datetime') is not None):
+        fix = dict(fix, datetime=timestamps.format_local(fix['datetime']))
+    return(json.dumps(fix))
+
+
+class LiveRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the table of the LiveHTTPServer it belongs to.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        if (parts == ['positions']):
+            self.send_json('[' + ', '.join(fix_json(fix) for fix in self.server.table.latest()) + ']')
+        elif (len(parts) == 2 and parts[0] == 'positions'):
+            fix = self.server.table.latest(parts[1])
+            if (fix is None):
+                self.send_error(404, 'Unknown IMEI')
+            else:
+                self.send_json(fix_json(fix))
+        elif (parts == ['events']):
+            self.send_events(parse_qs(url.query).get('imei', [None])[0])
+        elif (parts and parts[0] == 'trips' and len(parts) <= 2 and self.server.trips is not None):
+            summary = self.server.trips.summary(parts[1] if len(parts) == 2 else None)
+            if (summary is None):
+                self.send_error(404, 'Unknown IMEI')
+            else:
+                self.send_json(json.dumps(summary))
+        elif (parts == ['metrics'] and self.server.metrics is not None):
+            body = self.server.metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def send_json(self, body):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self, imei):
+        """
+        Stream new fixes (of one device if imei is given) until the client goes away.
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        subscriber = self.server.table.subscribe()
+        try:
+            while (True):
+                try:
+                    fix = subscriber.get(timeout=KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    self.wfile.write(b': keep-alive\n\n')
+                else:
+                    if (imei is not None and fix['imei'] != imei):
+                        continue
+                    self.wfile.write(b'data: ' + fix_json(fix).encode() + b'\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.server.table.unsubscribe(subscriber)
+
+    def log_message(self, format, *args):
+        # Requests are not worth a line each on the server output
+        pass
+
+
+class LiveHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, table, metrics=None, trips=None):
+        super().__init__(address, LiveRequestHandler)
+        self.table = table
+        self.metrics = metrics
+        self.trips = trips
+
+
+def start_live_server(table, host='127.0.0.1', port=8000, metrics=None, trips=None):
+    """
+    Serve the table (and the metrics and trip summaries, if given) from a
+    background thread and return the HTTP server.
+    """
+    server = LiveHTTPServer((host, port), table, metrics, trips)
+    threading.Thread(target=server.serve_forever, name='LiveHTTPServer', daemon=True).start()
+    print('Live positions on http://%s:%s/positions' % (host, server.server_address[1]))
+    return(server)
@@ -0,0 +1,138 @@
+"""
+Buffered log writer.
+
+Each log file is owned by a single writer thread fed by a queue: producers
+(connection handlers) only enqueue complete lines, and the writer thread
+appends them in batches, keeping the file open between batches. Lines are
+therefore never interleaved, and a GPS packet no longer costs several
+open/close cycles.
+
+Files can be rotated by size and/or by age: the current file is renamed
+with a timestamp suffix and a new one is started. The renamed segment can
+be handed over to a callback (e.g. to archive it, see archive.py).
+"""
+
+from datetime import datetime
+import os
+import queue
+import threading
+import time
+
+
+class LogWriter:
+    """
+    Append lines to a file from a dedicated thread.
+    Pending lines are flushed once flushBytes are queued or flushInterval
+    seconds after the oldest pending line, whichever comes first.
+    """
+
+    def __init__(self, path, flushBytes=64 * 1024, flushInterval=1.0, maxBytes=None, rotateInterval=None, onRotate=None):
+        self.path = path
+        self.flushBytes = flushBytes
+        self.flushInterval = flushInterval
+        self.maxBytes = maxBytes
+        self.rotateInterval = rotateInterval
+        self.onRotate = onRotate
+        self.queue = queue.SimpleQueue()
+        self.file = None
+        self.openedAt = None
+        self.thread = threading.Thread(target=self.run, name='LogWriter(%s)' % os.path.basename(path), daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        """
+        Queue one complete line (including its trailing newline). Never blocks.
+        """
+        self.queue.put(line)
+
+    def flush(self):
+        """
+        Block until every line queued so far is written to disk.
+        """
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        """
+        Write pending lines, close the file and stop the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        """
+        Writer thread: gather lines into batches and write them.
+        """
+        batch = []
+        size = 0
+        deadline = None
+        while (True):
+            try:
+                item = self.queue.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = ''
+
+            if (isinstance(item, str) and item):
+                batch.append(item)
+                size += len(item)
+                if (deadline is None):
+                    deadline = time.monotonic() + self.flushInterval
+                if (size < self.flushBytes and time.monotonic() < deadline):
+                    continue
+
+            # Size or time threshold reached, explicit flush, or shutdown
+            if (batch):
+                self.write_batch(''.join(batch))
+                batch = []
+                size = 0
+            deadline = None
+
+            if (item is None):
+                if (self.file):
+                    self.file.close()
+                return
+            if (isinstance(item, threading.Event)):
+                item.set()
+
+    def write_batch(self, data):
+        """
+        Write a batch of whole lines, rotating the file beforehand if needed.
+        """
+        if (self.file is None):
+            self.open()
+        elif (self.needs_rotation(len(data))):
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self.file = open(self.path, 'a+')
+        self.openedAt = time.time()
+
+    def needs_rotation(self, incoming):
+        """
+        A file is rotated when it would grow past maxBytes,
+        or when it was opened more than rotateInterval seconds ago.
+        """
+        if (self.maxBytes and self.file.tell() > 0 and self.file.tell() + incoming > self.maxBytes):
+            return(True)
+        if (self.rotateInterval and time.time() - self.openedAt >= self.rotateInterval):
+            return(True)
+        return(False)
+
+    def rotate(self):
+        """
+        Rename the current file with a timestamp suffix and start a new one.
+        """
+        self.file.close()
+        rotated = self.path + '.' + datetime.now().strftime('%Y%m%d-%H%M%S')
+        suffix = 1
+        while (os.path.exists(rotated)):
+            rotated = self.path + '.' + datetime.now().strftime('%Y%m%d-%H%M%S') + '.' + str(suffix)
+            suffix += 1
+        os.replace(self.path, rotated)
+        self.open()
+        if (self.onRotate):
+            self.onRotate(rotated)
@@ -0,0 +1,97 @@
+"""
+HTML maps of the fixes, rendered with folium.
+
+These used to live in server.py; they are kept apart so that the ingest
+server never imports folium (and pandas behind it), nor NumPy.
+Fixes are read from the position store written by the server.
+
+Usage: python maps.py dot [--imei IMEI] [--start 'YYYY/MM/DD HH:MM:SS'] [--stop ...] [--zoom 19]
+       python maps.py line [--imei IMEI] [--start ...] [--stop ...] [--zoom 19]
+       python maps.py heat [--cluster]
+"""
+
+import argparse
+
+import folium
+from folium import features, plugins
+import numpy as np
+
+import heatmap
+import position_store
+import simplify
+import timestamps
+
+
+def dot_map(imei=None, start=None, stop=None, zoom=19, budget=simplify.POINT_BUDGET, bucket=None):
+    '''Creating dot map using folium library. Making htlm file.
+    Fixes are read from the position store, optionally for one device and a time range (epoch seconds),
+    and simplified down to at most budget points (see simplify.simplify_track)'''
+    records = position_store.select(position_store.DEFAULT_DIRECTORY, imei, start, stop)
+    if (len(records) == 0):
+        print('No fixes to map' + (' for IMEI ' + imei if imei else '') + (' in this time range' if start is not None or stop is not None else '') + '.')
+        return
+    records = simplify.simplify_records(records, zoom, budget, bucket)
+    lat=float(records['latitude'][-1])
+    lon=float(records['longitude'][-1])
+    m = folium.Map([lat,lon], zoom_start=zoom)
+    for lat, lon in zip(records['latitude'].tolist(), records['longitude'].tolist()):
+        folium.CircleMarker((lat, lon), radius=3, weight=2, color='red', fill_color='red', fill_opacity=.5).add_to(m)
+    m.save('Map.html')
+
+
+
+def map_to_html_line(imei=None, start=None, stop=None, zoom=19, budget=simplify.POINT_BUDGET, bucket=None):
+    '''Creating line map using folium library. Making htlm file.
+    Fixes are read from the position store, optionally for one device and a time range (epoch seconds),
+    and simplified down to at most budget points (see simplify.simplify_track)'''
+    records = position_store.select(position_store.DEFAULT_DIRECTORY, imei, start, stop)
+    if (len(records) == 0):
+        print('No fixes to map' + (' for IMEI ' + imei if imei else '') + (' in this time range' if start is not None or stop is not None else '') + '.')
+        return
+    records = simplify.simplify_records(records, zoom, budget, bucket)
+    lat=float(records['latitude'][-1])
+    lon=float(records['longitude'][-1])
+    m = folium.Map([lat,lon], zoom_start=zoom)
+    color_line = features.ColorLine(
+    positions=list(zip(records['latitude'].tolist(), records['longitude'].tolist())),colors=range(0, len(records)),weight=10)
+    color_line.add_to(m)
+    m.save('Map_line.html')
+
+
+def heat_map(cluster=False, cell=heatmap.DEFAULT_CELL):
+    '''Creating fleet overview map from fixes aggregated in a grid (see heatmap.py). Making htlm file.
+    Shows a heatmap of the cells, or client-side clusters of cells if cluster is True'''
+    lat, lon, counts = heatmap.updated_grid(heatmap.DEFAULT_CACHE, cell).cells()
+    busiest = int(np.argmax(counts))
+    m = folium.Map([float(lat[busiest]), float(lon[busiest])], zoom_start=13)
+    if (cluster):
+        # One marker per cell, with its number of fixes as tooltip
+        callback = ('function (row) {'
+                    'var marker = L.marker(new L.LatLng(row[0], row[1]));'
+                    'marker.bindTooltip(row[2] + " fixes");'
+                    'return marker; }')
+        plugins.FastMarkerCluster(np.column_stack((lat, lon, counts)).tolist(), callback=callback).add_to(m)
+        m.save('Map_cluster.html')
+    else:
+        plugins.HeatMap(np.column_stack((lat, lon, counts / counts.max())).tolist()).add_to(m)
+        m.save('Map_heat.html')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTML maps of the fixes of the position store')
+    parser.add_argument('map', choices=('dot', 'line', 'heat'))
+    parser.add_argument('--imei', help='only this device (dot and line maps)')
+    parser.add_argument('--start', help="local time, 'YYYY/MM/DD HH:MM:SS'")
+    parser.add_argument('--stop', help="local time, 'YYYY/MM/DD HH:MM:SS'")
+    parser.add_argument('--zoom', type=int, default=19)
+    parser.add_argument('--cluster', action='store_true', help='clusters of cells instead of a heatmap')
+    args = parser.parse_args()
+
+    start = timestamps.parse_local(args.start) if args.start else None
+    stop = timestamps.parse_local(args.stop) if args.stop else None
+    if (args.map == 'dot'):
+        dot_map(args.imei, start, stop, args.zoom)
+    elif (args.map == 'line'):
+        map_to_html_line(args.imei, start, stop, args.zoom)
+    else:
+        heat_map(args.cluster)
@@ -0,0 +1,240 @@
+"""
+Instrumentation of the server hot path.
+
+Keeps, for the current process:
+    - a counter of packets per protocol name (from protocol_dict),
+    - histograms of decode and respond latencies,
+    - gauges of active connections and counters of bytes in/out.
+They can be scraped in the Prometheus text format (GET /metrics on the live
+HTTP endpoint) or dumped periodically to the output. In worker mode, each
+worker reports snapshots of its metrics to the parent, which serves their
+sum (WorkerMetrics).
+
+Per-packet tracing (hex dumps, decoded fields) is off by default: it is
+enabled with set_trace_sampling(n), which traces one packet out of n. When
+it is off, the hot path does no string formatting at all.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+from codec import protocol_dict
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+
+
+class Histogram:
+    """
+    Histogram with the count of each bucket (not cumulative), plus sum and count.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value, count=1):
+        self.counts[bisect.bisect_left(self.buckets, value)] += count
+        self.sum += value * count
+        self.count += count
+
+    def add(self, counts, total, count):
+        """
+        Add the bucket counts, sum and count of another histogram (same buckets).
+        """
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+    def quantile(self, fraction):
+        """
+        Upper bound of the bucket holding the given quantile.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if (count and seen >= rank):
+                return(bound)
+        return(None)
+
+
+class Metrics:
+    """
+    All metrics of the process. Updates take a single lock, so that
+    handler threads can share them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.packets = dict.fromkeys(protocol_dict['protocol'].values(), 0)
+        self.decode = Histogram()
+        self.respond = Histogram()
+        self.connections = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.started = time.time()
+
+    def packet(self, protocol_name, decodeTime, respondTime):
+        with self.lock:
+            self.packets[protocol_name] += 1
+            self.decode.observe(decodeTime)
+            self.respond.observe(respondTime)
+
+    def batch(self, protocol_name, count, decodeTime, respondTime):
+        """
+        Packets handled at once: each is accounted for its share of the times.
+        """
+        with self.lock:
+            self.packets[protocol_name] += count
+            self.decode.observe(decodeTime / count, count)
+            self.respond.observe(respondTime / count, count)
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+    def disconnected(self):
+        with self.lock:
+            self.connections -= 1
+
+    def received(self, size):
+        with self.lock:
+            self.bytesIn += size
+
+    def sent(self, size):
+        with self.lock:
+            self.bytesOut += size
+
+    def snapshot(self):
+        """
+        Copy of the metrics as plain values, to be sent to another process.
+        """
+        with self.lock:
+            return({'packets': dict(self.packets),
+                    'decode': (list(self.decode.counts), self.decode.sum, self.decode.count),
+                    'respond': (list(self.respond.counts), self.respond.sum, self.respond.count),
+                    'connections': self.connections, 'bytesIn': self.bytesIn, 'bytesOut': self.bytesOut})
+
+    def add(self, snapshot):
+        """
+        Add a snapshot (see snapshot()) to these metrics.
+        """
+        with self.lock:
+            for name, count in snapshot['packets'].items():
+                self.packets[name] = self.packets.get(name, 0) + count
+            self.decode.add(*snapshot['decode'])
+            self.respond.add(*snapshot['respond'])
+            self.connections += snapshot['connections']
+            self.bytesIn += snapshot['bytesIn']
+            self.bytesOut += snapshot['bytesOut']
+
+    def prometheus(self):
+        """
+        Metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = ['# TYPE tracker_packets_total counter']
+            lines += ['tracker_packets_total{protocol="%s"} %d' % (name, count) for name, count in self.packets.items()]
+            for name, histogram in (('tracker_decode_seconds', self.decode), ('tracker_respond_seconds', self.respond)):
+                lines.append('# TYPE %s histogram' % name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%s"} %d' % (name, '+Inf' if bound == float('inf') else repr(bound), cumulative))
+                lines.append('%s_sum %r' % (name, histogram.sum))
+                lines.append('%s_count %d' % (name, histogram.count))
+            lines += [
+                '# TYPE tracker_active_connections gauge',
+                'tracker_active_connections %d' % self.connections,
+                '# TYPE tracker_bytes_in_total counter',
+                'tracker_bytes_in_total %d' % self.bytesIn,
+                '# TYPE tracker_bytes_out_total counter',
+                'tracker_bytes_out_total %d' % self.bytesOut,
+            ]
+        return('\n'.join(lines) + '\n')
+
+    def summary(self):
+        """
+        One-line summary for periodic dumps.
+        """
+        with self.lock:
+            busiest = sorted(((count, name) for name, count in self.packets.items() if count), reverse=True)[:5]
+            return('connections=%d packets=%d [%s] bytes_in=%d bytes_out=%d decode_p50<=%s respond_p99<=%s' % (
+                self.connections, sum(self.packets.values()), ' '.join('%s=%d' % (name, count) for count, name in busiest),
+                self.bytesIn, self.bytesOut, self.decode.quantile(0.5), self.respond.quantile(0.99)))
+
+
+class WorkerMetrics:
+    """
+    Metrics of the worker processes, as last reported by each of them.
+    Served by the parent like its own Metrics, summed over the workers.
+    """
+
+    def __init__(self):
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def update(self, worker, snapshot):
+        with self.lock:
+            self.snapshots[worker] = snapshot
+
+    def combined(self):
+        metrics = Metrics()
+        with self.lock:
+            snapshots = list(self.snapshots.values())
+        for snapshot in snapshots:
+            metrics.add(snapshot)
+        return(metrics)
+
+    def prometheus(self):
+        return(self.combined().prometheus())
+
+    def summary(self):
+        return(self.combined().summary())
+
+
+def start_dump(metrics, interval):
+    """
+    Print a summary of the metrics every interval seconds, from a background thread.
+    """
+    def dump():
+        while (True):
+            time.sleep(interval)
+            print('METRICS [', os.getpid(), ']', metrics.summary())
+    threading.Thread(target=dump, name='MetricsDump', daemon=True).start()
+
+
+# Sampled tracing: one packet out of traceEvery is traced (0 = never)
+traceEvery = 0
+traceCounter = 0
+traceState = threading.local()
+
+
+def set_trace_sampling(every):
+    global traceEvery
+    traceEvery = every
+
+
+def begin_packet():
+    """
+    Decide whether the packet about to be handled by this thread is traced.
+    """
+    global traceCounter
+    if (not traceEvery):
+        return(False)
+    traceCounter += 1
+    traceState.on = traceCounter % traceEvery == 0
+    return(traceState.on)
+
+
+def tracing():
+    """
+    Whether the packet currently handled by this thread is traced.
+    """
+    return(traceEvery and getattr(traceState, 'on', False))
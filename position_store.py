@@ -0,0 +1,392 @@
+"""
+Append-only binary store of GPS fixes.
+
+Fixes are stored as fixed-width little-endian records, in one file per
+device (<imei>.bin, with the 15 digits of the IMEI, leading zeros included)
+so that reading a device never touches the others.
+Every BLOCK_RECORDS records, the time range of the block is appended to a
+sidecar index (<imei>.idx), which lets readers skip whole blocks that are
+outside the requested time range.
+
+Writing only needs the standard library; reading maps the files as NumPy
+structured arrays, without parsing anything.
+
+Usage: python position_store.py import logs/location_log.txt [--store logs/positions]
+"""
+
+import argparse
+import os
+import struct
+import threading
+
+import timestamps
+
+
+# IMEI, reception time, fix time (epoch seconds, UTC), latitude, longitude,
+# speed, heading, number of satellites, validity, padding
+RECORD = struct.Struct('<QqqddHHBB2x')
+# Min and max fix time of a full block
+INDEX = struct.Struct('<qq')
+BLOCK_RECORDS = 1024
+# TSV rows converted at once by import_tsv
+IMPORT_CHUNK = 65536
+
+# Where the server writes its fixes
+DEFAULT_DIRECTORY = './logs/positions/'
+# IMEIs are 15 digits; the numeric imei column drops their leading zeros
+IMEI_DIGITS = 15
+
+# Same layout as RECORD, for NumPy readers
+DTYPE_FIELDS = [
+    ('imei', '<u8'),
+    ('received', '<i8'),
+    ('time', '<i8'),
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('speed', '<u2'),
+    ('heading', '<u2'),
+    ('nb_sat', 'u1'),
+    ('valid', 'u1'),
+    ('padding', 'V2')
+]
+
+
+def record_dtype():
+    """
+    NumPy dtype of a record (NumPy is only imported by readers and bulk writers).
+    """
+    import numpy as np
+    return(np.dtype(DTYPE_FIELDS))
+
+
+def records_array(imei, received, fixTime, latitude, longitude, speed, heading, nb_sat, valid):
+    """
+    NumPy array of records (record_dtype()) from columns given in the order of
+    PositionStore.append(): arrays of the same length, or scalars shared by all
+    records (e.g. the IMEI). Times are epoch seconds.
+    """
+    import numpy as np
+    records = np.zeros(len(latitude), dtype=record_dtype())
+    records['imei'] = imei
+    records['received'] = received
+    records['time'] = fixTime
+    records['latitude'] = latitude
+    records['longitude'] = longitude
+    records['speed'] = speed
+    records['heading'] = heading
+    records['nb_sat'] = nb_sat
+    records['valid'] = valid
+    return(records)
+
+
+def imei_text(imei):
+    """
+    IMEI as the 15-digit string naming the files of a device, from a string
+    or from the imei column of records (e.g. 12345678901234 -> '012345678901234').
+    """
+    return(str(imei).zfill(IMEI_DIGITS))
+
+
+def data_path(directory, imei):
+    return(os.path.join(directory, imei_text(imei) + '.bin'))
+
+
+def index_path(directory, imei):
+    return(os.path.join(directory, imei_text(imei) + '.idx'))
+
+
+def pad_file_names(directory):
+    """
+    Rename the files of devices named without the leading zeros of their IMEI
+    (as written by former versions) to their 15-digit names.
+    """
+    for name in os.listdir(directory):
+        stem, extension = os.path.splitext(name)
+        if (extension in ('.bin', '.idx') and stem.isdigit() and len(stem) < IMEI_DIGITS):
+            padded = os.path.join(directory, imei_text(stem) + extension)
+            if (not os.path.exists(padded)):
+                os.rename(os.path.join(directory, name), padded)
+
+
+class PositionStore:
+    """
+    Buffered writer of fixes. Records are kept in memory and appended to the
+    device files by a background thread every flushInterval seconds, or as
+    soon as flushRecords are pending. Safe to use from several threads:
+    appending only takes the lock of the pending records, never the one held
+    during file I/O (without flusher thread, append() writes the full batch itself).
+    """
+
+    def __init__(self, directory, flushRecords=256, flushInterval=1.0):
+        self.directory = directory
+        self.flushRecords = flushRecords
+        self.flushInterval = flushInterval
+        self.pending = {}
+        self.nbPending = 0
+        # Per device: [number of records on disk, min and max time of the current block]
+        self.blocks = {}
+        # lock guards pending records, writeLock the files and block states:
+        # writeLock is always taken first, so batches reach the files in order
+        self.lock = threading.Lock()
+        self.writeLock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        pad_file_names(directory)
+        self.closed = threading.Event()
+        self.full = threading.Event()
+        if (flushInterval):
+            threading.Thread(target=self.run, name='PositionStore', daemon=True).start()
+
+    def run(self):
+        """
+        Flusher thread: write pending records every flushInterval seconds,
+        or once append() reports flushRecords pending.
+        """
+        while (not self.closed.is_set()):
+            self.full.wait(self.flushInterval)
+            self.full.clear()
+            self.flush()
+
+    def append(self, imei, received, fixTime, latitude, longitude, speed, heading, nb_sat, valid):
+        """
+        Queue one fix. Times are epoch seconds.
+        """
+        record = (int(imei), int(received), int(fixTime), latitude, longitude, speed, heading, nb_sat, int(valid))
+        with self.lock:
+            self.pending.setdefault(imei_text(imei), []).append(record)
+            self.nbPending += 1
+            full = self.nbPending >= self.flushRecords
+        if (full):
+            if (self.flushInterval):
+                self.full.set()
+            else:
+                self.flush()
+
+    def flush(self):
+        """
+        Write every pending record to disk.
+        """
+        with self.writeLock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.nbPending = 0
+            for imei, records in pending.items():
+                self.write_records(imei, records)
+
+    def close(self):
+        """
+        Write pending records and stop the flusher thread.
+        """
+        self.closed.set()
+        self.full.set()
+        self.flush()
+
+    def write_records(self, imei, records):
+        """
+        Append records to a device file, and index every block they complete.
+        Called with writeLock held.
+        """
+        block = self.blocks.get(imei)
+        if (block is None):
+            block = self.load_block_state(imei)
+        entries = []
+        for record in records:
+            fixTime = record[2]
+            block[1] = fixTime if block[1] is None else min(block[1], fixTime)
+            block[2] = fixTime if block[2] is None else max(block[2], fixTime)
+            block[0] += 1
+            if (block[0] % BLOCK_RECORDS == 0):
+                entries.append(INDEX.pack(block[1], block[2]))
+                block[1] = block[2] = None
+        with open(data_path(self.directory, imei), 'ab') as data:
+            data.write(b''.join(RECORD.pack(*record) for record in records))
+        if (entries):
+            with open(index_path(self.directory, imei), 'ab') as index:
+                index.write(b''.join(entries))
+
+    def write_array(self, imei, records):
+        """
+        Append a NumPy array of records (record_dtype()) of one device straight to its file,
+        after the records of that device still pending, and index every block they complete.
+        """
+        imei = imei_text(imei)
+        with self.writeLock:
+            with self.lock:
+                pending = self.pending.pop(imei, None)
+                if (pending):
+                    self.nbPending -= len(pending)
+            if (pending):
+                self.write_records(imei, pending)
+            block = self.blocks.get(imei)
+            if (block is None):
+                block = self.load_block_state(imei)
+            entries = []
+            times = records['time']
+            position = 0
+            while (position < len(times)):
+                # Records that go into the current block
+                size = min(BLOCK_RECORDS - block[0] % BLOCK_RECORDS, len(times) - position)
+                low = int(times[position:position + size].min())
+                high = int(times[position:position + size].max())
+                block[1] = low if block[1] is None else min(block[1], low)
+                block[2] = high if block[2] is None else max(block[2], high)
+                block[0] += size
+                position += size
+                if (block[0] % BLOCK_RECORDS == 0):
+                    entries.append(INDEX.pack(block[1], block[2]))
+                    block[1] = block[2] = None
+            with open(data_path(self.directory, imei), 'ab') as data:
+                data.write(records.tobytes())
+            if (entries):
+                with open(index_path(self.directory, imei), 'ab') as index:
+                    index.write(b''.join(entries))
+
+    def load_block_state(self, imei):
+        """
+        Rebuild the state of the last (incomplete) block of a device from its file.
+        """
+        block = [0, None, None]
+        path = data_path(self.directory, imei)
+        if (os.path.exists(path)):
+            count = os.path.getsize(path) // RECORD.size
+            block[0] = count
+            with open(path, 'rb') as data:
+                data.seek((count - count % BLOCK_RECORDS) * RECORD.size)
+                for record in RECORD.iter_unpack(data.read((count % BLOCK_RECORDS) * RECORD.size)):
+                    block[1] = record[2] if block[1] is None else min(block[1], record[2])
+                    block[2] = record[2] if block[2] is None else max(block[2], record[2])
+        self.blocks[imei] = block
+        return(block)
+
+
+def devices(directory):
+    """
+    List the IMEIs that have fixes in the store.
+    """
+    if (not os.path.isdir(directory)):
+        return([])
+    return(sorted(name[:-4] for name in os.listdir(directory) if name.endswith('.bin')))
+
+
+def count(directory, imei):
+    """
+    Number of records stored for a device.
+    """
+    path = data_path(directory, imei)
+    return(os.path.getsize(path) // RECORD.size if os.path.exists(path) else 0)
+
+
+def load(directory, imei, start=None, stop=None, offset=0, end=None):
+    """
+    Load the fixes of one device as a NumPy structured array.
+    start and stop (epoch seconds, inclusive) restrict the fix time range:
+    only the indexed blocks overlapping that range, plus the unindexed tail,
+    are read from the memory-mapped file.
+    offset skips the first records (e.g. those already loaded by a previous call)
+    and end ignores records from that position onwards.
+    """
+    import numpy as np
+
+    dtype = record_dtype()
+    n = count(directory, imei) if end is None else min(end, count(directory, imei))
+    if (n <= offset):
+        return(np.empty(0, dtype=dtype))
+    records = np.memmap(data_path(directory, imei), dtype=dtype, mode='r', shape=(n,))
+    if (start is None and stop is None):
+        return(np.array(records[offset:]))
+
+    start = np.iinfo(np.int64).min if start is None else start
+    stop = np.iinfo(np.int64).max if stop is None else stop
+
+    # Select blocks from the index, then always scan the unindexed tail
+    slices = []
+    path = index_path(directory, imei)
+    nbBlocks = 0
+    if (os.path.exists(path)):
+        index = np.fromfile(path, dtype=np.dtype([('min', '<i8'), ('max', '<i8')]))
+        nbBlocks = len(index)
+        for b in np.nonzero((index['max'] >= start) & (index['min'] <= stop))[0]:
+            slices.append(records[max(b * BLOCK_RECORDS, offset):(b + 1) * BLOCK_RECORDS])
+    slices.append(records[max(nbBlocks * BLOCK_RECORDS, offset):])
+
+    selected = np.concatenate(slices)
+    return(selected[(selected['time'] >= start) & (selected['time'] <= stop)])
+
+
+def tail(directory, imei, offset, start=None, stop=None):
+    """
+    Load the fixes of a device appended since a previous call.
+    Returns (records, offset) where offset is to be passed to the next call.
+    """
+    end = count(directory, imei)
+    return((load(directory, imei, start, stop, offset, end), max(end, offset)))
+
+
+def load_all(directory, start=None, stop=None):
+    """
+    Load the fixes of every device, ordered by fix time.
+    """
+    import numpy as np
+
+    arrays = [load(directory, imei, start, stop) for imei in devices(directory)]
+    if (not arrays):
+        return(np.empty(0, dtype=record_dtype()))
+    records = np.concatenate(arrays)
+    return(records[np.argsort(records['time'], kind='stable')])
+
+
+def select(directory, imei=None, start=None, stop=None):
+    """
+    Load the fixes of a single device if imei is given, or of every device.
+    """
+    if (imei is None):
+        return(load_all(directory, start, stop))
+    return(load(directory, imei, start, stop))
+
+
+def import_tsv(path, directory):
+    """
+    One-shot import of an existing location_log.txt into the store.
+    Columns: timestamp, IP, IMEI, method, fix datetime, validity, number of satellites,
+    latitude, longitude, accuracy, speed, heading.
+    Returns the number of imported fixes.
+    """
+    store = PositionStore(directory, flushRecords=65536, flushInterval=None)
+    imported = 0
+    rows = []
+    with open(path) as log:
+        for line in log:
+            columns = line.rstrip('\n').split('\t')
+            if (len(columns) < 12):
+                continue
+            rows.append(columns)
+            if (len(rows) >= IMPORT_CHUNK):
+                imported += import_rows(store, rows)
+                rows = []
+    imported += import_rows(store, rows)
+    store.close()
+    return(imported)
+
+
+def import_rows(store, rows):
+    """
+    Append a chunk of TSV rows to the store. Both datetime columns are
+    converted to epoch seconds at once, for the whole chunk.
+    """
+    received = timestamps.parse_local_array([columns[0] for columns in rows])
+    fixTimes = timestamps.parse_local_array([columns[4] for columns in rows])
+    for columns, receivedTime, fixTime in zip(rows, received.tolist(), fixTimes.tolist()):
+        store.append(columns[2], receivedTime, fixTime,
+                     float(columns[7]), float(columns[8]), int(columns[10]), int(columns[11]),
+                     int(columns[6]), int(columns[5]))
+    return(len(rows))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='binary position store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    importer = subparsers.add_parser('import', help='import a TSV location log')
+    importer.add_argument('path', help='location_log.txt to import')
+    importer.add_argument('--store', default=DEFAULT_DIRECTORY, help='store directory')
+    args = parser.parse_args()
+
+    if (args.command == 'import'):
+        print('Imported', import_tsv(args.path, args.store), 'fixes into', args.store)
@@ -0,0 +1,196 @@
+"""
+Offline replay of the raw packet log.
+
+server_log.txt keeps every packet received (IN) and sent (OUT) as hex,
+with the IP and IMEI of the device. This tool re-derives the fixes from the
+GPS packets of that log, with the decoders of codec.py (vectorized for
+frames of the usual size) and the rules of answer_gps(), without any socket, and writes them to a position store (and, optionally, to a
+location log in the format of location_log.txt).
+
+Logs are split into chunks of about CHUNK_BYTES, aligned on line ends,
+which a pool of processes decodes in parallel. Archived segments
+(server_log.txt.*.gz, see archive.py) are split along their compressed
+blocks, and only the blocks of the requested device are read if --imei is given. Each chunk comes back as
+one array of records per IMEI, in log order, and the device files of the
+store are appended in the order the packets were received.
+
+Usage: python replay.py logs/server_log.txt.20200719-000000.gz [... logs/server_log.txt]
+                        [--store logs/positions_rebuilt] [--location rebuilt_location_log.txt] [--imei IMEI]
+"""
+
+import argparse
+import binascii
+import multiprocessing
+import os
+import struct
+import time
+
+import numpy as np
+
+import archive
+import codec
+import position_store
+import timestamps
+
+
+# Bytes of log decoded by a process at once
+CHUNK_BYTES = 32 * 1024 * 1024
+# Where rebuilt fixes are written by default (not the live store, to avoid duplicates)
+DEFAULT_STORE = './logs/positions_rebuilt/'
+# Hex of the protocol byte of GPS frames (0x10 and 0x11), at hex offset 6
+GPS_PROTOCOLS = (b'10', b'11')
+
+
+def chunks(path, chunkBytes=CHUNK_BYTES, imei=None):
+    """
+    Split a log file into (path, start, stop, imei) byte ranges of about chunkBytes,
+    each ending at the end of a line. Ranges of an archive are runs of consecutive
+    blocks (holding about chunkBytes of text), among those that may hold imei.
+    """
+    ranges = []
+    if (path.endswith(archive.ARCHIVE_SUFFIX)):
+        start = stop = text = None
+        for entry in archive.select_blocks(archive.read_index(path), imei):
+            if (start is not None and (entry['offset'] != stop or text >= chunkBytes)):
+                ranges.append((path, start, stop, imei))
+                start = None
+            if (start is None):
+                start = entry['offset']
+                text = 0
+            stop = entry['offset'] + entry['size']
+            text += entry['text']
+        if (start is not None):
+            ranges.append((path, start, stop, imei))
+        return(ranges)
+
+    size = os.path.getsize(path)
+    start = 0
+    with open(path, 'rb') as log:
+        while (start < size):
+            log.seek(min(start + chunkBytes, size))
+            log.readline()
+            stop = min(log.tell(), size)
+            ranges.append((path, start, stop, imei))
+            start = stop
+    return(ranges)
+
+
+def replay_chunk(task, withLocation=False):
+    """
+    Decode the GPS packets of a range of the log (of one device if the task has an IMEI).
+    Returns (fixes, location lines, number of lines, number of undecodable packets),
+    where fixes maps each IMEI to a NumPy array of its records (position_store.record_dtype()),
+    in log order.
+    """
+    path, start, stop, imei = task
+    with open(path, 'rb') as log:
+        log.seek(start)
+        data = log.read(stop - start)
+    if (path.endswith(archive.ARCHIVE_SUFFIX)):
+        data = archive.decompress_members(data)
+    imeiColumn = imei.encode('ascii') if imei is not None else None
+
+    # Keep the columns of the GPS frames (protocols 0x10 and 0x11) received from logged-in devices
+    rows = []
+    errors = 0
+    for line in data.split(b'\n'):
+        if (b'\tIN\t7878' not in line):
+            continue
+        columns = line.rstrip(b'\r').split(b'\t')
+        if (len(columns) != 5 or columns[4][6:8] not in GPS_PROTOCOLS):
+            continue
+        if (imeiColumn is not None and columns[2] != imeiColumn):
+            continue
+        if (len(columns[0]) != 19 or not columns[2].isdigit()):
+            errors += 1
+            continue
+        rows.append(columns)
+
+    # Frames of the usual size are decoded at once; any other goes through codec.decode()
+    hexFrames = [columns[4] for columns in rows]
+    regular = [len(frame) == 2 * codec.GPS_FRAME_SIZE for frame in hexFrames]
+    try:
+        fields = codec.decode_gps_array(binascii.unhexlify(b''.join(frame for frame, isRegular in zip(hexFrames, regular) if isRegular)))
+    except binascii.Error:
+        fields = None
+    if (fields is None or not all(regular)):
+        # Per frame, so that a corrupted one is skipped alone
+        decoded = []
+        for columns in rows:
+            try:
+                protocol, frameFields = codec.decode(binascii.unhexlify(columns[4]))
+            except (binascii.Error, struct.error, IndexError, ValueError):
+                errors += 1
+                continue
+            decoded.append((columns, frameFields))
+        rows = [columns for columns, frameFields in decoded]
+        fields = [np.array(values) for values in zip(*(frameFields for columns, frameFields in decoded))] if decoded else [np.empty((0, 6))] + [np.empty(0)] * 6
+    dt_fields, nb_sat, latitude, longitude, speed, valid, heading = fields
+
+    # Times are converted at once for the whole chunk; as in answer_gps(),
+    # empty GPS datetimes are replaced by the reception time
+    receivedTexts = [columns[0].decode('ascii') for columns in rows]
+    received = timestamps.parse_local_array(receivedTexts)
+    fixTimes = timestamps.epochs_from_fields(dt_fields.reshape(-1, 6))
+    fixTimes = np.where(fixTimes < 0, received, fixTimes)
+
+    records = position_store.records_array([int(columns[2]) for columns in rows], received, fixTimes,
+                                           latitude, longitude, speed, heading, nb_sat, valid)
+
+    # Group by device, keeping the log order of each
+    order = np.argsort(records['imei'], kind='stable')
+    imeis, starts = np.unique(records['imei'][order], return_index=True)
+    fixes = {position_store.imei_text(imei): records[indices] for imei, indices in zip(imeis, np.split(order, starts[1:]))}
+
+    location = []
+    if (withLocation):
+        for columns, receivedText, fixTime, fix in zip(rows, receivedTexts, fixTimes.tolist(), records.tolist()):
+            location.append('\t'.join((receivedText, columns[1].decode('ascii'), columns[2].decode('ascii'), 'GPS', timestamps.format_local(fixTime),
+                                       str(fix[8]), str(fix[7]), str(fix[3]), str(fix[4]), '0.0', str(fix[5]), str(fix[6]))) + '\n')
+    return((fixes, location, data.count(b'\n'), errors))
+
+
+def replay_chunk_location(task):
+    return(replay_chunk(task, withLocation=True))
+
+
+def replay(paths, directory=DEFAULT_STORE, locationPath=None, processes=None, chunkBytes=CHUNK_BYTES, imei=None):
+    """
+    Replay log files, in the given order, into the store in directory
+    (and into a location log if locationPath is given), optionally for one device only.
+    Returns (number of lines, number of fixes, number of undecodable packets).
+    """
+    tasks = [task for path in paths for task in chunks(path, chunkBytes, imei)]
+    store = position_store.PositionStore(directory, flushInterval=None)
+    location = open(locationPath, 'w') if locationPath else None
+    nbLines = nbFixes = nbErrors = 0
+    worker = replay_chunk_location if location else replay_chunk
+    with multiprocessing.Pool(processes) as pool:
+        for fixes, lines, chunkLines, chunkErrors in pool.imap(worker, tasks):
+            for imei, records in fixes.items():
+                store.write_array(imei, records)
+                nbFixes += len(records)
+            if (location):
+                location.writelines(lines)
+            nbLines += chunkLines
+            nbErrors += chunkErrors
+    if (location):
+        location.close()
+    return((nbLines, nbFixes, nbErrors))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rebuild positions from the raw packet log')
+    parser.add_argument('paths', nargs='+', help='server_log.txt files or archives, oldest first')
+    parser.add_argument('--store', default=DEFAULT_STORE, help='position store directory to write')
+    parser.add_argument('--location', help='also write a location log (location_log.txt format) to this file')
+    parser.add_argument('--processes', type=int, help='number of decoding processes (default: one per CPU)')
+    parser.add_argument('--imei', help='only replay the packets of this device')
+    parser.add_argument('--chunk-mb', type=int, default=CHUNK_BYTES // (1024 * 1024), help='MiB of log per chunk')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    nbLines, nbFixes, nbErrors = replay(args.paths, args.store, args.location, args.processes, args.chunk_mb * 1024 * 1024, args.imei)
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(path) for path in args.paths)
+    print('Replayed', nbLines, 'lines into', nbFixes, 'fixes (%d undecodable) in %.1fs, %.0f MB/s' % (nbErrors, elapsed, size / elapsed / 1e6))
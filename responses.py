@@ -0,0 +1,94 @@
+"""
+Cache of response frames.
+
+Most responses barely change, so they are built once and reused:
+    - frames of the protocols answered without content are prebuilt,
+    - datetime acknowledgements (GPS 0x10/0x11 and time 0x30) are built once
+      per second and shared by all connections,
+    - setup responses are built once per device, until its setup changes.
+"""
+
+import threading
+import time
+
+import codec
+
+
+# Frames of the protocols answered with their own protocol number and no content
+generic_responses = {protocol: codec.make_content_response(protocol) for protocol in codec.protocol_names}
+
+# Accepted login
+LOGIN_ACCEPTED = codec.make_content_response(0x01, b'\x01')
+
+# Protocols acknowledged with the current datetime, and whether their year is truncated
+DATETIME_PROTOCOLS = {0x10: True, 0x11: True, 0x30: False}
+
+
+def generic_response(protocol):
+    """
+    Prebuilt response without content (built on the fly for unknown protocols).
+    """
+    r = generic_responses.get(protocol)
+    return(r if r is not None else codec.make_content_response(protocol))
+
+
+def datetime_content(second, truncatedYear):
+    """
+    Current GMT datetime as YY MM DD HH MM SS (truncatedYear) or YY YY MM DD HH MM SS.
+    """
+    t = time.gmtime(second)
+    if (truncatedYear):
+        return(codec.DATETIME_SHORT.pack(t.tm_year % 100, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec))
+    return(codec.DATETIME_LONG.pack(t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec))
+
+
+# Second for which the datetime frames were built, and the frames by protocol
+datetime_frames = (None, {})
+
+
+def datetime_response(protocol):
+    """
+    Datetime acknowledgement for the current second.
+    The frames of every datetime protocol are rebuilt at most once per second;
+    the cache is swapped as a whole, so readers never see a partial update.
+    """
+    global datetime_frames
+    second = int(time.time())
+    cached, frames = datetime_frames
+    if (cached != second):
+        frames = {p: codec.make_content_response(p, datetime_content(second, truncated)) for p, truncated in DATETIME_PROTOCOLS.items()}
+        datetime_frames = (second, frames)
+    return(frames[protocol])
+
+
+class SetupCache:
+    """
+    Setup response of every device: defaults, overridden per IMEI by
+    set_device_setup(). Frames are built on first use and kept until the
+    setup of that device changes.
+    """
+
+    def __init__(self, defaults):
+        self.defaults = defaults
+        self.overrides = {}
+        self.frames = {}
+        self.lock = threading.Lock()
+
+    def response(self, imei, protocol=0x57):
+        r = self.frames.get(imei)
+        if (r is None):
+            # Built under the lock, so that a concurrent set_device_setup()
+            # cannot have its change overwritten by a frame of the former setup
+            with self.lock:
+                setup = dict(self.defaults, **self.overrides.get(imei, {}))
+                r = codec.make_content_response(protocol, codec.encode_setup(**setup))
+                self.frames[imei] = r
+        return(r)
+
+    def set_device_setup(self, imei, **setup):
+        """
+        Change some setup values of a device (see codec.encode_setup for their names).
+        """
+        with self.lock:
+            self.overrides.setdefault(imei, {}).update(setup)
+            self.frames.pop(imei, None)
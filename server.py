@@ -1,19 +1,31 @@
 
-from dotenv import load_dotenv
-from socket import AF_INET, socket, SOCK_STREAM
+from socket import AF_INET, socket, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, timeout as socket_timeout
 from threading import Thread
-from datetime import datetime
-from dateutil import tz
-import math
+import argparse
+import asyncio
+import atexit
+import multiprocessing
+import signal
 import os
-from pyngrok import ngrok
-import pandas as pd
+import sys
+import time
 import threading
 
-
-import folium
-import http.server
-import socketserver
+# The ingest path only needs the standard library and the modules below:
+# maps (folium, NumPy) live in maps.py, and ngrok is imported when started
+import archive
+import codec
+from codec import protocol_dict
+from logwriter import LogWriter
+import position_store
+import geofence
+import live
+import metrics
+import responses
+import sessions
+import timestamps
+import trips
+import workers
 
 
     
@@ -27,13 +39,14 @@ def accept_incoming_connections():
         client, client_address = SERVER.accept()
         print('%s:%s has connected.' % client_address)
         
-        # Initialize the dictionaries
-        addresses[client] = {}
-        positions[client] = {}
-        
-        # Add current client address into adresses
-        addresses[client]['address'] = client_address
-        Thread(target=handle_client, args=(client,)).start()
+        # The session of this connection holds the client state
+        # (daemon thread: an idle device must not keep the process from exiting)
+        session = sessions.Session(client, client_address)
+        if (not session_table.connect(session)):
+            # Server stopping (see stop_threads)
+            client.close()
+            return
+        Thread(target=handle_client, args=(session,), daemon=True).start()
 
 
 def LOGGER(event, filename, ip, client, type, data):
@@ -41,31 +54,73 @@ def LOGGER(event, filename, ip, client, type, data):
     A logging function to store all input packets, 
     as well as output ones when they are generated.
 
-    There are two types of logs implemented: 
+    There are three types of logs implemented: 
         - a general (info) logger that will keep track of all 
             incoming and outgoing packets,
         - a position (location) logger that will write to a 
-            file contianing only results og GPS data
+            file contianing only results og GPS data,
+        - a geofence logger, for devices entering or leaving a fence
+
+    Lines are handed over to the writer thread of each file,
+    which appends them in batches. Info and location data can also be
+    lists (of packets or positions), written as one block of lines.
     """
     
-    with open(os.path.join('./logs/', filename), 'a+') as log:
-        if (event == 'info'):
-            # TSV format of: Timestamp, Client IP, IN/OUT, Packet
-            logMessage = datetime.now().strftime('%Y/%m/%d %H:%M:%S') + '\t' + ip + '\t' + client + '\t' + type + '\t' + data + '\n'
-        elif (event == 'location'):
-            # TSV format of: Timestamp, Client IP, Location DateTime, GPS, Validity, Nb Sat, Latitude, Longitude, Accuracy, Speed, Heading
-            logMessage = datetime.now().strftime('%Y/%m/%d %H:%M:%S') + '\t' + ip + '\t' + client + '\t' + '\t'.join(list(str(x) for x in data.values())) + '\n'
-        log.write(logMessage)
+    if (event == 'info'):
+        # TSV format of: Timestamp, Client IP, IN/OUT, Packet
+        prefix = timestamps.format_local(time.time()) + '\t' + ip + '\t' + client + '\t' + type + '\t'
+        if (isinstance(data, list)):
+            logMessage = ''.join(prefix + packet + '\n' for packet in data)
+        else:
+            logMessage = prefix + data + '\n'
+    elif (event == 'location'):
+        # TSV format of: Timestamp, Client IP, Location DateTime, GPS, Validity, Nb Sat, Latitude, Longitude, Accuracy, Speed, Heading
+        # (the location datetime is kept as epoch seconds until now)
+        prefix = timestamps.format_local(time.time()) + '\t' + ip + '\t' + client + '\t'
+        logMessage = ''.join(prefix + '\t'.join(str(x) for x in dict(position, datetime=timestamps.format_local(position['datetime'])).values()) + '\n'
+                             for position in (data if isinstance(data, list) else [data]))
+    elif (event == 'geofence'):
+        # TSV format of: Timestamp, Client IP, IMEI, ENTER/EXIT, Fence, Location DateTime, Latitude, Longitude
+        logMessage = timestamps.format_local(time.time()) + '\t' + ip + '\t' + client + '\t' + type + '\t' + '\t'.join(str(x) for x in data) + '\n'
+    get_log_writer(filename).write(logMessage)
+
+
+def get_log_writer(filename):
+    """
+    Return the writer of a log file, starting it on first use.
+    """
+    writer = log_writers.get(filename)
+    if (writer is None):
+        with log_writers_lock:
+            writer = log_writers.get(filename)
+            if (writer is None):
+                writer = LogWriter(os.path.join('./logs/', filename), **log_rotation.get(filename, {}))
+                log_writers[filename] = writer
+    return(writer)
 
 
-def handle_client(client):
+def close_log_writers():
     """
-    Takes client socket as argument. 
-    Handles a single client connection, by listening indefinitely for packets.
+    Flush and close every log file; registered to run at exit.
+    """
+    for writer in list(log_writers.values()):
+        writer.close()
+    log_writers.clear()
+
+
+def handle_client(session):
+    """
+    Takes the session of a client socket as argument. 
+    Handles a single client connection, by listening for packets until the
+    device disconnects or stays silent for longer than its read timeout.
+    The acks of each read are written before reading again, within
+    WRITE_TIMEOUT: a device that stops reading them is disconnected.
     """
     
-    # Initialize dictionaries for that client
-    positions[client]['gps'] = {}
+    client = session.client
+    server_metrics.connected()
+    # Reassembly buffer for frames split across (or coalesced within) reads
+    frames = codec.FrameBuffer()
 
     # Keep receiving and analyzing packets until end of time
     # or until device sends disconnection signal
@@ -74,36 +129,341 @@ def handle_client(client):
 
         # Handle socket errors with a try/except approach
         try:
+            client.settimeout(session.read_timeout())
             packet = client.recv(BUFSIZ)
             
             # Only process non-empty packets
             if (len(packet) > 0):
-                print('[', addresses[client]['address'][0], ']', 'IN Hex :', packet.hex(), '(length in bytes =', len(packet), ')')
-                keepAlive = read_incoming_packet(client, packet)
-                LOGGER('info', 'server_log.txt', addresses[client]['address'][0], addresses[client]['imei'], 'IN', packet.hex())
+                # Process every complete frame of this read as a batch,
+                # then write all their acks at once
+                server_metrics.received(len(packet))
+                client.settimeout(sessions.WRITE_TIMEOUT)
+                keepAlive = read_incoming_frames(session, frames.feed(packet))
+                flush_responses(session)
                 
                 # Disconnect if client sent disconnect signal
                 #if (keepAlive is False):
-                #    print('[', addresses[client]['address'][0], ']', 'DISCONNECTED: socket was closed by client.')
+                #    print('[', session.address[0], ']', 'DISCONNECTED: socket was closed by client.')
                 #    client.close()
                 #    break
 
             # Close socket if recv() returns 0 bytes, i.e. connection has been closed
             else:
-                print('[', addresses[client]['address'][0], ']', 'DISCONNECTED: socket was closed for an unknown reason.')
+                print('[', session.address[0], ']', 'DISCONNECTED: socket was closed for an unknown reason.')
                 client.close()
                 break                
 
+        # Dead socket (no FIN) or silent device, or device that does not read its acks
+        except socket_timeout:
+            if (session.outbox):
+                print('[', session.address[0], ']', 'DISCONNECTED:', len(session.outbox), 'bytes of acks not read for', sessions.WRITE_TIMEOUT, 'seconds.')
+            else:
+                print('[', session.address[0], ']', 'DISCONNECTED: no packet for', session.read_timeout(), 'seconds.')
+            client.close()
+            break
+
         # Something went sideways... close the socket so that it does not hang
         except Exception as e:
-            print('[', addresses[client]['address'][0], ']', 'ERROR: socket was closed due to the following exception:')
+            print('[', session.address[0], ']', 'ERROR: socket was closed due to the following exception:')
             print(e)
             client.close()
             break
+    session_table.close(session)
+    server_metrics.disconnected()
     print("This thread is now closed.")
 
 
-def read_incoming_packet(client, packet):
+class AsyncClient:
+    """
+    Socket-like wrapper around an asyncio StreamWriter.
+    It exposes the few methods used by the dispatch functions and sessions
+    (send, close, shutdown),
+    so that read_incoming_packet() and all answer_* functions work unchanged
+    whether the client is a blocking socket or an asyncio stream.
+    Sends never block: bytes are queued in the transport buffer, and the
+    connection handler waits on drain() when that buffer is above its limit.
+    """
+    __slots__ = ('writer',)
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def send(self, data):
+        self.writer.write(data)
+        return(len(data))
+
+    def close(self):
+        self.writer.close()
+
+    def shutdown(self, how):
+        # Closing the transport feeds EOF to the reader of the connection
+        self.writer.close()
+
+
+async def handle_client_async(reader, writer):
+    """
+    Asyncio counterpart of handle_client().
+    Each connection is a coroutine instead of a thread, so idle devices only
+    cost a socket and a small StreamReader, and thousands of them can be
+    kept open in a single process.
+    """
+    session = sessions.Session(AsyncClient(writer), writer.get_extra_info('peername')[:2])
+    if (not session_table.connect(session)):
+        # Server stopping (see serve_async)
+        writer.close()
+        return
+    frames = codec.FrameBuffer()
+    server_metrics.connected()
+    print('%s:%s has connected.' % session.address)
+
+    # Bound the outgoing buffer: write() never blocks, but drain() will
+    # suspend this connection (and only this one) once the limit is reached
+    writer.transport.set_write_buffer_limits(high=sessions.OUTBOX_HIGH_WATER)
+
+    try:
+        while (True):
+            try:
+                packet = await asyncio.wait_for(reader.read(BUFSIZ), timeout=session.read_timeout())
+            except asyncio.TimeoutError:
+                # Dead socket (no FIN) or silent device
+                print('[', session.address[0], ']', 'DISCONNECTED: no packet for', session.read_timeout(), 'seconds.')
+                break
+
+            # Close connection if read() returns 0 bytes, i.e. EOF
+            if (len(packet) == 0):
+                print('[', session.address[0], ']', 'DISCONNECTED: socket was closed for an unknown reason.')
+                break
+
+            # Process every complete frame of this read as a batch,
+            # then hand all their acks to the transport at once
+            server_metrics.received(len(packet))
+            keepAlive = read_incoming_frames(session, frames.feed(packet))
+            flush_responses(session)
+
+            # A device that does not read its acks must not pin memory forever
+            try:
+                await asyncio.wait_for(writer.drain(), timeout=sessions.WRITE_TIMEOUT)
+            except asyncio.TimeoutError:
+                print('[', session.address[0], ']', 'DISCONNECTED:', writer.transport.get_write_buffer_size(), 'bytes of acks not read for', sessions.WRITE_TIMEOUT, 'seconds.')
+                # Closing would wait for the buffer to be written: drop it
+                writer.transport.abort()
+                break
+
+    # Server stopping (serve_async() returned): end like any disconnection,
+    # as the stream callback of asyncio does not expect a cancelled handler
+    except asyncio.CancelledError:
+        print('[', session.address[0], ']', 'DISCONNECTED: server is stopping.')
+
+    # Something went sideways... close the socket so that it does not hang
+    except Exception as e:
+        print('[', session.address[0], ']', 'ERROR: socket was closed due to the following exception:')
+        print(repr(e))
+
+    finally:
+        writer.close()
+        server_metrics.disconnected()
+        session_table.close(session)
+
+
+def run_worker(number, queue, useAsyncio, sharedSocket, metricsInterval=None):
+    """
+    Entry point of a worker process, forked by serve_workers().
+    Sessions stay local to the worker, while log lines, fixes and live
+    positions are funneled to the parent process.
+    """
+    global SERVER, position_writer, live_table, trip_tracker
+
+    funnel = workers.Funnel(queue)
+    for filename in ('server_log.txt', 'location_log.txt', 'geofence_log.txt'):
+        log_writers[filename] = workers.FunnelLogWriter(funnel, filename)
+    position_writer = workers.FunnelPositionStore(funnel)
+    live_table = workers.FunnelLiveTable(funnel)
+    trip_tracker = workers.FunnelTripTracker(funnel)
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    SERVER = sharedSocket if sharedSocket is not None else workers.reuse_port_socket(ADDR, ASYNC_BACKLOG)
+    # Metrics are per process: each worker dumps its own, and reports them to the parent for /metrics
+    if (metricsInterval):
+        metrics.start_dump(server_metrics, metricsInterval)
+    workers.report_metrics(funnel, number, server_metrics)
+    print('Worker', number, '(pid', os.getpid(), ')')
+    # The parent stops workers with SIGTERM, which only ends the serving loop:
+    # serving returns once the connection handlers are stopped, and pending
+    # items are handed over below, from the main thread, as it never holds the
+    # Funnel lock (it does not serve connections itself)
+    try:
+        if (useAsyncio):
+            asyncio.run(serve_async())
+        else:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            serve_threads(ASYNC_BACKLOG)
+    finally:
+        funnel.close()
+
+
+def serve_workers(nbWorkers, useAsyncio, livePort=None, metricsInterval=None):
+    """
+    Runs nbWorkers worker processes accepting on the same port, through
+    SO_REUSEPORT where available (each worker binds its own socket and the
+    kernel balances connections), or else by sharing one listening socket.
+    The parent process writes everything the workers funnel to it.
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    if (workers.reuse_port_available()):
+        SERVER.close()
+        sharedSocket = None
+    else:
+        SERVER.listen(ASYNC_BACKLOG)
+        sharedSocket = SERVER
+
+    processes = [context.Process(target=run_worker, args=(n, queue, useAsyncio, sharedSocket, metricsInterval), name='worker-%d' % n, daemon=True) for n in range(nbWorkers)]
+    for process in processes:
+        process.start()
+    # Stopping the parent with SIGTERM also stops the workers (below) and flushes the logs (atexit)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # Every thread of the parent (archiver, position store, drainer, live
+    # server) is started after forking, so that workers inherit none of them
+    start_writers()
+    worker_metrics = metrics.WorkerMetrics()
+    drainer = threading.Thread(target=workers.drain, args=(queue, get_log_writer, position_writer, live_table, trip_tracker, worker_metrics), name='Drain', daemon=True)
+    drainer.start()
+    if (livePort):
+        live.start_live_server(live_table, port=livePort, metrics=worker_metrics, trips=trip_tracker)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        queue.put(None)
+        drainer.join()
+
+
+def preload_batch_decoding():
+    """
+    Import NumPy, which answer_gps_batch() needs, from a background thread once
+    the process accepts connections: neither startup nor the first burst of
+    offline positions has to wait for it.
+    """
+    Thread(target=codec.decode_gps_array, args=(b'',), name='Preload', daemon=True).start()
+
+
+def raise_open_files_limit():
+    """
+    Raise the soft limit on open file descriptors up to the hard limit,
+    so that the asyncio server can hold more than ~1000 sockets.
+    Silently does nothing on platforms without the resource module.
+    """
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if (hard == resource.RLIM_INFINITY or soft < hard):
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+async def serve_async():
+    """
+    Runs the asyncio server on the already bound SERVER socket
+    until the process is interrupted or receives SIGTERM.
+    SIGTERM is handled by the event loop itself, between two callbacks, so it
+    never lands in the middle of a packet (and of the locks it takes).
+    """
+    raise_open_files_limit()
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    server = await asyncio.start_server(handle_client_async, sock=SERVER, backlog=ASYNC_BACKLOG)
+    print("Waiting for connection (asyncio)...")
+    preload_batch_decoding()
+    await stop.wait()
+    server.close()
+    # As in stop_threads(): shut every connection down and give their handlers
+    # STOP_TIMEOUT seconds to end (those still running are then cancelled by
+    # asyncio.run(), and a cancellation may be lost in wait_for())
+    session_table.shutdown_all(0)
+    handlers = asyncio.all_tasks() - {asyncio.current_task()}
+    if (handlers):
+        await asyncio.wait(handlers, timeout=STOP_TIMEOUT)
+
+
+def serve_threads(backlog=5):
+    """
+    Runs the threaded server on the already bound SERVER socket
+    until the process is interrupted.
+    Connections are accepted (and handled) by daemon threads, while the main
+    thread only waits: a signal then ends that wait and nothing else. The
+    handlers are then stopped (see stop_threads) before returning.
+    """
+    SERVER.listen(backlog)
+    print("Waiting for connection...")
+    preload_batch_decoding()
+    accepter = Thread(target=accept_incoming_connections, name='Accept', daemon=True)
+    accepter.start()
+    try:
+        accepter.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_threads()
+
+
+def stop_threads():
+    """
+    Stop the connection handlers of the threaded server: new connections are
+    refused, open ones are shut down, and their handlers are given up to
+    STOP_TIMEOUT seconds to end. Once this returns, nothing is logged or
+    stored anymore, and the writers can be closed.
+    The listening socket is left as is: worker processes may share it.
+    """
+    remaining = session_table.shutdown_all(STOP_TIMEOUT)
+    if (remaining):
+        print(remaining, 'connection handlers still running after', STOP_TIMEOUT, 'seconds.')
+
+
+def read_incoming_frames(session, frames):
+    """
+    Handle the complete frames of one read, in order.
+    Runs of at least GPS_BATCH_MIN GPS frames of the same protocol from a
+    logged-in device (typically the offline backlog it flushes when it
+    reconnects) are handled at once by answer_gps_batch(); every other
+    frame goes through read_incoming_packet().
+    """
+    keepAlive = True
+    position = 0
+    while (position < len(frames)):
+        # Run of GPS frames of the usual size and of the same protocol
+        protocol = frames[position][codec.PROTOCOL_OFFSET]
+        end = position
+        if (session.imei is not None and protocol in GPS_BATCH_PROTOCOLS):
+            while (end < len(frames) and len(frames[end]) == codec.GPS_FRAME_SIZE and frames[end][codec.PROTOCOL_OFFSET] == protocol):
+                end += 1
+        if (end - position >= GPS_BATCH_MIN):
+            answer_gps_batch(session, protocol, frames[position:end])
+            position = end
+            continue
+
+        frame = frames[position]
+        if (metrics.begin_packet()):
+            print('[', session.address[0], ']', 'IN Hex :', frame.hex(), '(length in bytes =', len(frame), ')')
+        keepAlive = read_incoming_packet(session, frame)
+        LOGGER('info', 'server_log.txt', session.address[0], session.imei, 'IN', frame.hex())
+        position += 1
+    return(keepAlive)
+
+
+def read_incoming_packet(session, packet):
     """
     Handle incoming packets to identify the protocol they are related to,
     and then redirects to response functions that will generate the apropriate 
@@ -111,44 +471,48 @@ def read_incoming_packet(client, packet):
     Actual sending of the response packet will be done by an external function.
     """
 
-    # Convert hex string into list for convenience
-    # Strip packet of bits 1 and 2 (start 0x78 0x78) and n-1 and n (end 0x0d 0x0a)
-    packet_list = [packet.hex()[i:i+2] for i in range(4, len(packet.hex())-4, 2)]
-    
-    # DEBUG: Print the role of current packet
-    protocol_name = protocol_dict['protocol'][packet_list[1]]
-    protocol_method = protocol_dict['response_method'][protocol_name]
-    print('The current packet is for protocol:', protocol_name, 'which has method:', protocol_method)
+    # Decode the frame straight from its bytes: protocol byte and content fields
+    start = time.perf_counter()
+    protocol, fields = codec.decode(packet)
+    protocol_name = codec.protocol_names[protocol]
+    decoded = time.perf_counter()
+
+    # DEBUG: Print the role of current packet (sampled tracing only)
+    if (metrics.tracing()):
+        print('The current packet is for protocol:', protocol_name, 'which has method:', protocol_dict['response_method'][protocol_name])
     # Get the protocol name and react accordingly
+    keepAlive = True
+    r = None
     if (protocol_name == 'login'):
-        r = answer_login(client, packet_list)
+        r = answer_login(session, protocol, fields)
     
     elif (protocol_name == 'gps_positioning' or protocol_name == 'gps_offline_positioning'):
-        r = answer_gps(client, packet_list)
+        r = answer_gps(session, protocol, fields)
 
     elif (protocol_name == 'status'):
         # Status can sometimes carry signal strength and sometimes not
-        if (packet_list[0] == '06'): 
-            print('[', addresses[client]['address'][0], ']', 'STATUS : Battery =', int(packet_list[2], base=16), '; Sw v. =', int(packet_list[3], base=16), '; Status upload interval =', int(packet_list[4], base=16))
-        elif (packet_list[0] == '07'): 
-            print('[', addresses[client]['address'][0], ']', 'STATUS : Battery =', int(packet_list[2], base=16), '; Sw v. =', int(packet_list[3], base=16), '; Status upload interval =', int(packet_list[4], base=16), '; Signal strength =', int(packet_list[5], base=16))
-        # Exit function without altering anything
-        return(True)
+        # No response is sent
+        if (metrics.tracing()):
+            battery, software_version, upload_interval, signal_strength = fields
+            if (signal_strength is None):
+                print('[', session.address[0], ']', 'STATUS : Battery =', battery, '; Sw v. =', software_version, '; Status upload interval =', upload_interval)
+            else:
+                print('[', session.address[0], ']', 'STATUS : Battery =', battery, '; Sw v. =', software_version, '; Status upload interval =', upload_interval, '; Signal strength =', signal_strength)
     
     elif (protocol_name == 'hibernation'):
-        # Exit function returning False to break main while loop in handle_client()
-        print('[', addresses[client]['address'][0], ']', 'STATUS : Sent hibernation packet. Disconnecting now.')
-        return(False)
+        # Return False to break main while loop in handle_client()
+        print('[', session.address[0], ']', 'STATUS : Sent hibernation packet. Disconnecting now.')
+        keepAlive = False
 
     elif (protocol_name == 'setup'):
         # TODO: HANDLE NON-DEFAULT VALUES
-        r = answer_setup(packet_list, '0300', '00110001', '000000', '000000', '000000', '00', '000000', '000000', '000000', '00', '0000', '0000', ['', '', ''])
+        r = answer_setup(session, protocol)
 
     elif (protocol_name == 'time'):
-        r = answer_time(packet_list)
+        r = answer_time(protocol)
 
     elif (protocol_name == 'position_upload_interval'):
-        r = answer_upload_interval(client, packet_list)
+        r = answer_upload_interval(session, protocol, fields)
 
 
     # Otherwise, return a generic packet based on the current protocol number
@@ -156,85 +520,70 @@ def read_incoming_packet(client, packet):
     #    - reset
     #    - 
     else:
-        r = generic_response(packet_list[1])
+        r = generic_response(protocol)
     
     # Send response to client
-    print('[', addresses[client]['address'][0], ']', 'OUT Hex :', r, '(length in bytes =', len(bytes.fromhex(r)), ')')
-    send_response(client, r)
+    if (r is not None):
+        if (metrics.tracing()):
+            print('[', session.address[0], ']', 'OUT Hex :', r.hex().upper(), '(length in bytes =', len(r), ')')
+        send_response(session, r)
+    server_metrics.packet(protocol_name, decoded - start, time.perf_counter() - decoded)
     # Return True to avoid failing in main while loop in handle_client()
-    return(True)
+    return(keepAlive)
 
 
-def answer_login(client, query):
+def answer_login(session, protocol, fields):
     """
     This function extracts IMEI and Software Version from the login packet. 
-    The IMEI and Software Version will be stored into a client dictionary to 
+    The IMEI and Software Version will be stored into the client session to 
     allow handling of multiple devices at once, in the future.
     
-    The client socket is passed as an argument because it is in this packet
-    that IMEI is sent and will be stored in the address dictionary.
+    The session is passed as an argument because it is in this packet
+    that IMEI is sent: the session is then registered under that IMEI,
+    replacing (and disconnecting) any former session of the same device.
     """
     
-    # Read data: Bits 2 through 9 are IMEI and 10 is software version
-    protocol = query[1]
-    addresses[client]['imei'] = ''.join(query[2:10])[1:]
-    addresses[client]['software_version'] = int(query[10], base=16)
+    # IMEI and software version were decoded from bytes 2 through 9 and 10
+    imei, software_version = fields
+    former = session_table.login(session, imei, software_version)
 
     # DEBUG: Print IMEI and software version
-    print("Detected IMEI :", addresses[client]['imei'], "and Sw v. :", addresses[client]['software_version'])
+    print("Detected IMEI :", session.imei, "and Sw v. :", session.software_version)
+    if (former is not None):
+        print('[', former.address[0], ']', 'DISCONNECTED: replaced by a new session of the same device.')
 
     # Prepare response: in absence of control values, 
-    # always accept the client
-    response = '01'
-    # response = '44'
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'])
+    # always accept the client (prebuilt 0x01 frame)
+    r = responses.LOGIN_ACCEPTED
     return(r)
 
 
-def answer_setup(query, uploadIntervalSeconds, binarySwitch, alarm1, alarm2, alarm3, dndTimeSwitch, dndTime1, dndTime2, dndTime3, gpsTimeSwitch, gpsTimeStart, gpsTimeStop, phoneNumbers):
+def answer_setup(session, protocol):
     """
     Synchronous setup is initiated by the device who asks the server for 
     instructions.
     These instructions will consists of bits for different flags as well as
     alarm clocks ans emergency phone numbers.
+    The response of each device is built once, from setup_defaults and its own
+    values (see setup_cache.set_device_setup), and cached until these change.
     """
-    
-    # Read protocol
-    protocol = query[1]
-
-    # Convert binarySwitch from byte to hex
-    binarySwitch = format(int(binarySwitch, base=2), '02X')
-
-    # Convert phone numbers to 'ASCII' (?) by padding each digit with 3's and concatenate
-    for n in range(len(phoneNumbers)):
-        phoneNumbers[n] = bytes(phoneNumbers[n], 'UTF-8').hex()
-    phoneNumbers = '3B'.join(phoneNumbers)
-
-    # Build response
-    response = uploadIntervalSeconds + binarySwitch + alarm1 + alarm2 + alarm3 + dndTimeSwitch + dndTime1 + dndTime2 + dndTime3 + gpsTimeSwitch + gpsTimeStart + gpsTimeStop + phoneNumbers
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'])
+    r = setup_cache.response(session.imei, protocol)
     return(r)
 
 
-def answer_time(query):
+def answer_time(protocol):
     """
     Time synchronization is initiated by the device, which expects a response
     contianing current datetime over 7 bytes: YY YY MM DD HH MM SS.
     This function is a wrapper to generate the proper response
     """
-    
-    # Read protocol
-    protocol = query[1]
-
-    # Get current date and time into the pretty-fied hex format
-    response = get_hexified_datetime(truncatedYear=False)
 
-    # Build response
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'])
+    # Response with the current date and time, built once per second
+    r = responses.datetime_response(protocol)
     return(r)
 
 
-def answer_gps(client, query):
+def answer_gps(session, protocol, fields):
     """
     GPS positioning can come into two packets that have the exact same structure, 
     but protocol can be 0x10 (GPS positioning) or 0x11 (Offline GPS positioning)... ?
@@ -242,73 +591,113 @@ def answer_gps(client, query):
     """
 
     # Reset positions lists  and dictionary (carrier) for that client
-    positions[client]['gps'] = {}
-
-    # Read protocol
-    protocol = query[1]
+    session.gps = {}
 
-    # Extract datetime from incoming query to put into the response
-    # Datetime is in HEX format here
-    # That means it's read as HEX(YY) HEX(MM) HEX(DD) HEX(HH) HEX(MM) HEX(SS)...
-    dt = ''.join([ format(int(x, base = 16), '02d') for x in query[2:8] ])
-    # GPS DateTime is at UTC timezone: we need to convert it to local, while keeping the same format as a string
-    if (dt != '000000000000'): 
-        dt = datetime.strftime(datetime.strptime(dt, '%y%m%d%H%M%S').replace(tzinfo=tz.tzutc()).astimezone(tz.tzlocal()), '%y%m%d%H%M%S')
+    # Fields were decoded by the codec from the raw bytes
+    dt_fields, gps_nb_sat, gps_latitude, gps_longitude, gps_speed, position_is_valid, gps_heading = fields
 
-    
-    # Read in the incoming GPS positioning
-    # Byte 8 contains length of packet on 1st char and number of satellites on 2nd char
-    gps_data_length = int(query[8][0], base=16)
-    gps_nb_sat = int(query[8][1], base=16)
-    # Latitude and longitude are both on 4 bytes, and were multiplied by 30000
-    # after being converted to seconds-of-angle. Let's convert them back to degree
-    gps_latitude = int(''.join(query[9:13]), base=16) / (30000 * 60)
-    gps_longitude = int(''.join(query[13:17]), base=16) / (30000 * 60)
-    # Speed is on the next byte
-    gps_speed = int(query[17], base=16)
-    # Last two bytes contain flags in binary that will be interpreted
-    gps_flags = format(int(''.join(query[18:20]), base=16), '0>16b')
-    position_is_valid = gps_flags[3]
-    # Flip sign of GPS latitude if South, longitude if West
-    if (gps_flags[4] == '1'):
-        gps_latitude = -gps_latitude
-    if (gps_flags[5] == '0'):
-        gps_longitude = -gps_longitude
-    gps_heading = int(''.join(gps_flags[6:]), base = 2)
+    # Datetime was read as YY MM DD HH MM SS integers, at UTC: keep it as epoch seconds,
+    # it is only formatted to local time when written out
+    received = time.time()
+    fixTime = timestamps.epoch_from_fields(dt_fields)
+    # In some cases the datetime is empty (all zeros): use the reception time instead
+    if (fixTime is None):
+        fixTime = int(received)
 
     # Store GPS information into the position dictionary and print them
-    positions[client]['gps']['method'] = 'GPS'
-    # In some cases dt is empty with value '000000000000': let's avoid that because it'll crash strptime
-    positions[client]['gps']['datetime'] = datetime.strptime(datetime.now().strftime('%y%m%d%H%M%S') if dt == '000000000000' else dt, '%y%m%d%H%M%S').strftime('%Y/%m/%d %H:%M:%S')
-    positions[client]['gps']['valid'] = position_is_valid
-    positions[client]['gps']['nb_sat'] = gps_nb_sat
-    positions[client]['gps']['latitude'] = gps_latitude
-    positions[client]['gps']['longitude'] = gps_longitude
-    positions[client]['gps']['accuracy'] = 0.0
-    positions[client]['gps']['speed'] = gps_speed
-    positions[client]['gps']['heading'] = gps_heading
-    print('[', addresses[client]['address'][0], ']', "POSITION/GPS : Valid =", position_is_valid, "; Nb Sat =", gps_nb_sat, "; Lat =", gps_latitude, "; Long =", gps_longitude, "; Speed =", gps_speed, "; Heading =", gps_heading)
-    LOGGER('location', 'location_log.txt', addresses[client]['address'][0], addresses[client]['imei'], '', positions[client]['gps'])
-    # Get current datetime for answering
-    response = get_hexified_datetime(truncatedYear=True)
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'])
+    session.gps['method'] = 'GPS'
+    session.gps['datetime'] = fixTime
+    session.gps['valid'] = position_is_valid
+    session.gps['nb_sat'] = gps_nb_sat
+    session.gps['latitude'] = gps_latitude
+    session.gps['longitude'] = gps_longitude
+    session.gps['accuracy'] = 0.0
+    session.gps['speed'] = gps_speed
+    session.gps['heading'] = gps_heading
+    if (metrics.tracing()):
+        print('[', session.address[0], ']', "POSITION/GPS : Valid =", position_is_valid, "; Nb Sat =", gps_nb_sat, "; Lat =", gps_latitude, "; Long =", gps_longitude, "; Speed =", gps_speed, "; Heading =", gps_heading)
+    LOGGER('location', 'location_log.txt', session.address[0], session.imei, '', session.gps)
+    # Also store the fix in the binary position store, with times as epoch seconds
+    position_writer.append(session.imei, received, fixTime, gps_latitude, gps_longitude, gps_speed, gps_heading, gps_nb_sat, position_is_valid)
+    # Publish it to the live table served over HTTP
+    live_table.publish(session.imei, session.gps)
+    # Distance travelled, stops and trips
+    if (position_is_valid):
+        trip_tracker.update(session.imei, fixTime, gps_latitude, gps_longitude)
+    # Report the fences the device just entered or left
+    if (geofences is not None and position_is_valid):
+        for transition, fence in geofences.update(session.imei, gps_latitude, gps_longitude):
+            print('[', session.address[0], ']', 'GEOFENCE :', transition, fence, '; IMEI =', session.imei)
+            LOGGER('geofence', 'geofence_log.txt', session.address[0], session.imei, transition, (fence, timestamps.format_local(fixTime), gps_latitude, gps_longitude))
+    # Answer with the current datetime, built once per second
+    r = responses.datetime_response(protocol)
     return(r)
 
 
-def answer_upload_interval(client, query):
+def answer_gps_batch(session, protocol, frames):
+    """
+    Batch counterpart of answer_gps(), for a run of GPS frames of one protocol
+    from a logged-in device: the frames are decoded at once with NumPy
+    (codec.decode_gps_array), their fixes are appended to the position store
+    in one write, their log lines are handed over in one block per file, and
+    their responses are queued at once, to be written with a single send().
+    The live table, trips and geofences still see the fixes one by one, in
+    order (trips and geofences only the valid ones).
+    """
+
+    start = time.perf_counter()
+    protocol_name = codec.protocol_names[protocol]
+    imei = session.imei
+    ip = session.address[0]
+    LOGGER('info', 'server_log.txt', ip, imei, 'IN', [frame.hex() for frame in frames])
+    dt_fields, gps_nb_sat, gps_latitude, gps_longitude, gps_speed, position_is_valid, gps_heading = codec.decode_gps_array(b''.join(frames))
+    decoded = time.perf_counter()
+
+    # As in answer_gps(), empty datetimes are replaced by the reception time
+    received = time.time()
+    fixTimes = timestamps.epochs_from_fields(dt_fields)
+    fixTimes[fixTimes < 0] = int(received)
+    position_writer.write_array(imei, position_store.records_array(int(imei), received, fixTimes, gps_latitude, gps_longitude,
+                                                                        gps_speed, gps_heading, gps_nb_sat, position_is_valid))
+
+    # Positions as dictionaries of Python values, in the order of answer_gps()
+    positions = [{'method': 'GPS', 'datetime': fixTime, 'valid': valid, 'nb_sat': nb_sat, 'latitude': latitude, 'longitude': longitude,
+                  'accuracy': 0.0, 'speed': speed, 'heading': heading}
+                 for fixTime, valid, nb_sat, latitude, longitude, speed, heading
+                 in zip(fixTimes.tolist(), position_is_valid.tolist(), gps_nb_sat.tolist(), gps_latitude.tolist(),
+                        gps_longitude.tolist(), gps_speed.tolist(), gps_heading.tolist())]
+    if (metrics.begin_packet()):
+        print('[', ip, ']', 'POSITION/GPS :', len(positions), protocol_name, 'packets at once, the last one being', positions[-1])
+    LOGGER('location', 'location_log.txt', ip, imei, '', positions)
+    session.gps = positions[-1]
+    for position in positions:
+        # Every fix is an event for live subscribers, as with answer_gps()
+        live_table.publish(imei, position)
+        if (not position['valid']):
+            continue
+        trip_tracker.update(imei, position['datetime'], position['latitude'], position['longitude'])
+        if (geofences is not None):
+            for transition, fence in geofences.update(imei, position['latitude'], position['longitude']):
+                print('[', ip, ']', 'GEOFENCE :', transition, fence, '; IMEI =', imei)
+                LOGGER('geofence', 'geofence_log.txt', ip, imei, transition, (fence, timestamps.format_local(position['datetime']), position['latitude'], position['longitude']))
+
+    # One response per frame (the current datetime), all sent at once
+    r = responses.datetime_response(protocol)
+    send_responses(session, [r] * len(frames))
+    server_metrics.batch(protocol_name, len(frames), decoded - start, time.perf_counter() - decoded)
+
+
+def answer_upload_interval(session, protocol, fields):
     """
     Whenever the device received an SMS that changes the value of an upload interval,
     it sends this information to the server.
     The server should answer with the exact same content to acknowledge the packet.
     """
 
-    # Read protocol
-    protocol = query[1]
-
-    # Response is new upload interval reported by device (HEX formatted, no need to alter it)
-    response = ''.join(query[2:4])
+    # Response is new upload interval reported by device (raw bytes, no need to alter it)
+    response, = fields
 
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, response, hex_dict['stop_1'] + hex_dict['stop_2'])
+    r = codec.make_content_response(protocol, response)
     return(r)
 
 
@@ -317,174 +706,200 @@ def generic_response(protocol):
     Many queries made by the device do not expect a complex
     response: most of the times, the device expects the exact same packet.
     Here, we will answer fith the same value of protocol that the device sent, 
-    not using any content.
+    not using any content. These frames are prebuilt.
     """
-    r = make_content_response(hex_dict['start'] + hex_dict['start'], protocol, None, hex_dict['stop_1'] + hex_dict['stop_2'])
+    r = responses.generic_response(protocol)
     return(r)
 
 
-def make_content_response(start, protocol, content, stop):
+def send_response(session, response):
     """
-    This is just a wrapper to generate the complete response
-    to a query, goven its content.
-    It will apply to all packets where response is of the format:
-    start-start-length-protocol-content-stop_1-stop_2.
-    Other specific packets where length is replaced by counters
-    will be treated separately.
+    Function to send a response packet to the client.
+    Responses are queued in the outbox of the session, and written by the
+    connection handler once the frames of the current read are handled
+    (or as soon as the outbox reaches its high-water mark).
     """
-    return(start + format((len(bytes.fromhex(content)) if content else 0)+1, '02X') + protocol + (content if content else '') + stop)
+    LOGGER('info', 'server_log.txt', session.address[0], session.imei, 'OUT', response.hex().upper())
+    if (session.outbox.put(response)):
+        flush_responses(session)
 
 
-def send_response(client, response):
+def send_responses(session, packets):
     """
-    Function to send a response packet to the client.
+    Queue several response packets at once.
     """
-    LOGGER('info', 'server_log.txt', addresses[client]['address'][0], addresses[client]['imei'], 'OUT', response)
-    client.send(bytes.fromhex(response))
+    LOGGER('info', 'server_log.txt', session.address[0], session.imei, 'OUT', [packet.hex().upper() for packet in packets])
+    if (session.outbox.put(b''.join(packets))):
+        flush_responses(session)
 
 
-def get_hexified_datetime(truncatedYear):
+def flush_responses(session):
     """
-    Make a fancy function that will return current GMT datetime as hex
-    concatenated data, using 2 bytes for year and 1 for the rest.
-    The returned string is YY YY MM DD HH MM SS if truncatedYear is False,
-    or just YY MM DD HH MM SS if truncatedYear is True.
+    Write the queued responses of a session with as few writes as possible:
+    a socket takes them within its timeout (WRITE_TIMEOUT, set by
+    handle_client), an AsyncClient hands them to its transport.
     """
+    if (session.outbox):
+        server_metrics.sent(session.outbox.flush(session.client))
 
-    # Get current GMT time into a list
-    if (truncatedYear):
-        dt = datetime.utcnow().strftime('%y-%m-%d-%H-%M-%S').split("-")
-    else:
-        dt = datetime.utcnow().strftime('%Y-%m-%d-%H-%M-%S').split("-")
-
-    # Then convert to hex with 2 bytes for year and 1 for the rest
-    dt = [ format(int(x), '0'+str(len(x))+'X') for x in dt ]
-    return(''.join(dt))
-
-
-
-def dot_map():
-    '''Creating dot map using folium library. Making htlm file'''
-    df = pd.read_csv('logs/location_log.txt', header=None,sep='	')
-    m = folium.Map(location=[0,0], tiles='Stamen Toner', zoom_start=15)
-    lat=float(df.tail(1)[7])
-    lon=float(df.tail(1)[8])
-    m = folium.Map([lat,lon], zoom_start=19)
-    for i,row in df.iterrows():
-        folium.CircleMarker((df[7][i],df[8][i]), radius=3, weight=2, color='red', fill_color='red', fill_opacity=.5).add_to(m)
-    m.save('Map.html')
-
-
-  
-def map_to_html_line():
-    '''Creating line map using folium library. Making htlm file'''  
-    df = pd.read_csv('logs/location_log.txt', header=None,sep='	')
-    m = folium.Map(location=[0,0], tiles='Stamen Toner', zoom_start=15)
-    lat=float(df.tail(1)[7])
-    lon=float(df.tail(1)[8])
-    m = folium.Map([lat,lon], zoom_start=19)
-    color_line = features.ColorLine(
-    positions=list(zip(df[7].tolist(), df[8].tolist())),colors=range(0, len(df[7])),weight=10)
-    color_line.add_to(m)
-    m.save('Map_line.html')
 
-    
 def start_ngrok():
     '''Open a ssh tunel to static wan ip address, requires ngrok api key'''
-    ssh_url = ngrok.connect(PORT, "tcp")
+    # Import dotenv with API keys and initialize API connections
+    from dotenv import load_dotenv
+    from pyngrok import ngrok
+    load_dotenv()
+    ssh_url = ngrok.connect(ADDR[1], "tcp")
     print('static ip address :',ssh_url)
 
 
 
 
 
-# Declare common Hex codes for packets
-hex_dict = {
-    'start': '78', 
-    'stop_1': '0D', 
-    'stop_2': '0A'
+# Default answer to synchronous setup requests
+setup_defaults = {
+    'uploadIntervalSeconds': 0x0300,
+    'binarySwitch': 0b00110001,
+    'alarms': (b'\x00\x00\x00', b'\x00\x00\x00', b'\x00\x00\x00'),
+    'dndTimeSwitch': 0x00,
+    'dndTimes': (b'\x00\x00\x00', b'\x00\x00\x00', b'\x00\x00\x00'),
+    'gpsTimeSwitch': 0x00,
+    'gpsTimeStart': 0x0000,
+    'gpsTimeStop': 0x0000,
+    'phoneNumbers': ('', '', '')
 }
-
-protocol_dict = {
-    'protocol': {
-        '01': 'login',
-        '05': 'supervision',
-        '08': 'heartbeat', 
-        '10': 'gps_positioning', 
-        '11': 'gps_offline_positioning', 
-        '13': 'status', 
-        '14': 'hibernation', 
-        '15': 'reset', 
-        '16': 'whitelist_total', 
-        '17': 'wifi_offline_positioning', 
-        '30': 'time', 
-        '43': 'mom_phone_WTFISDIS?', 
-        '56': 'stop_alarm', 
-        '57': 'setup', 
-        '58': 'synchronous_whitelist', 
-        '67': 'restore_password', 
-        '69': 'wifi_positioning', 
-        '80': 'manual_positioning', 
-        '81': 'battery_charge', 
-        '82': 'charger_connected', 
-        '83': 'charger_disconnected', 
-        '94': 'vibration_received', 
-        '98': 'position_upload_interval'
-    }, 
-    'response_method': {
-        'login': 'login',
-        'logout': 'logout', 
-        'supervision': '',
-        'heartbeat': '', 
-        'gps_positioning': 'datetime_response', 
-        'gps_offline_positioning': 'datetime_response', 
-        'status': '', 
-        'hibernation': '', 
-        'reset': '', 
-        'whitelist_total': '', 
-        'wifi_offline_positioning': 'datetime_position_response', 
-        'time': 'time_response', 
-        'stop_alarm': '', 
-        'setup': 'setup', 
-        'synchronous_whitelist': '', 
-        'restore_password': '', 
-        'wifi_positioning': 'datetime_position_response', 
-        'manual_positioning': '', 
-        'battery_charge': '', 
-        'charger_connected': '', 
-        'charger_disconnected': '', 
-        'vibration_received': '', 
-        'position_upload_interval': 'upload_interval_response'
-    }
-}
-
-# Import dotenv with API keys and initialize API connections
-load_dotenv()
+# Setup responses, cached per device
+setup_cache = responses.SetupCache(setup_defaults)
 
 # Details about host server
 HOST ='0.0.0.0'
 PORT =60000
-BUFSIZ = 4096
+# Large reads are fine: frames coalesced in one read are all processed
+BUFSIZ = 65536
 ADDR = (HOST, PORT)
 
-# Initialize socket
-SERVER = socket(AF_INET, SOCK_STREAM)
-SERVER.bind(ADDR)
-# Store client data into dictionaries
-addresses = {}
-positions = {}
+# GPS frames handled at once (see read_incoming_frames): protocols, and
+# minimum length of a run, below which NumPy costs more than it saves
+GPS_BATCH_PROTOCOLS = (0x10, 0x11)
+GPS_BATCH_MIN = 12
+
+# Asyncio mode: listen backlog (outbound limits are in sessions.py)
+ASYNC_BACKLOG = 1024
+# Threaded mode: seconds the connection handlers are given to end at shutdown
+STOP_TIMEOUT = 5
+
+# Set up by serve(): listening socket, archiver of the raw packet log,
+# and binary store of all fixes (read by maps.py and window.py)
+SERVER = None
+log_archiver = None
+position_writer = None
+
+# Log files are written by one LogWriter thread each. The raw packet log
+# is rotated daily or at 64 MiB, and each rotated segment is compressed
+# into a seekable archive (see archive.py); positions are kept in a single file
+log_rotation = {
+    'server_log.txt': {'maxBytes': 64 * 1024 * 1024, 'rotateInterval': 24 * 3600}
+}
+log_writers = {}
+log_writers_lock = threading.Lock()
 
+# Latest fix of every device, served by the live HTTP endpoint
+live_table = live.LiveTable()
 
+# Odometer, stops and trips of every device, also served by the live HTTP endpoint
+trip_tracker = trips.TripTracker()
 
-if __name__ == '__main__':
+# Counters, latency histograms and gauges of this process
+server_metrics = metrics.Metrics()
+
+# Sessions of the logged-in devices, by IMEI
+session_table = sessions.SessionTable()
+
+# Fences evaluated on every valid fix (None: no geofencing)
+geofences = None
+
+
+def bind_server(address):
+    """
+    Listening socket of the server. SO_REUSEADDR lets a restarted server bind
+    at once, instead of failing while connections of the former one are in TIME_WAIT.
+    """
+    server = socket(AF_INET, SOCK_STREAM)
+    server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server.bind(address)
+    return(server)
+
+
+def start_writers():
+    """
+    Start the archiver of the raw packet log and the position store, and
+    register their closing, and the closing of the log writers, at exit.
+    """
+    global log_archiver, position_writer
+
+    # Registered first so that they run last, after the log writers are closed
+    log_archiver = archive.Archiver()
+    atexit.register(log_archiver.close)
+    log_rotation['server_log.txt']['onRotate'] = log_archiver.submit
+    # Segments rotated before a previous shutdown but not archived yet
+    for segment in archive.rotated_segments('./logs/server_log.txt'):
+        log_archiver.submit(segment)
+    position_writer = position_store.PositionStore(position_store.DEFAULT_DIRECTORY)
+    atexit.register(position_writer.close)
+    atexit.register(close_log_writers)
+
+
+def serve(useAsyncio=False, nbWorkers=None, port=PORT, livePort=None, metricsInterval=None, geofencePath=None):
+    """
+    Entry point of the server: starts the log archiver and the position store,
+    binds the listening socket and accepts devices until interrupted.
+    None of this happens at import, so that importing this module binds no
+    port and starts no thread.
+    """
+    global SERVER, ADDR, geofences
+
+    ADDR = (HOST, port)
+    # Worker processes are forked before any thread is started (see serve_workers)
+    if (not nbWorkers):
+        start_writers()
+
+    if (geofencePath):
+        geofences = geofence.GeofenceEngine(geofence.load_fences(geofencePath))
+        print('Loaded', len(geofences), 'geofences from', geofencePath)
+    if (metricsInterval and not nbWorkers):
+        metrics.start_dump(server_metrics, metricsInterval)
+    if (livePort and not nbWorkers):
+        live.start_live_server(live_table, port=livePort, metrics=server_metrics, trips=trip_tracker)
+
+    SERVER = bind_server(ADDR)
     #start_ngrok()
-    SERVER.listen(5)
-    print("Waiting for connection...")
-    t1 = threading.Thread(target=accept_incoming_connections)
-    t1.start()
-    t1.join()
-    SERVER.close()
-        
-    
-    
-    
\ No newline at end of file
+    # Log lines and fixes are buffered for up to a second: a service stop
+    # (SIGTERM) must exit through atexit, which flushes them
+    try:
+        if (nbWorkers):
+            serve_workers(nbWorkers, useAsyncio, livePort, metricsInterval)
+        elif (useAsyncio):
+            try:
+                asyncio.run(serve_async())
+            except KeyboardInterrupt:
+                pass
+        else:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            serve_threads()
+    finally:
+        SERVER.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='zx303 tracking server')
+    parser.add_argument('--asyncio', action='store_true', help='serve all devices from a single asyncio event loop instead of one thread per device')
+    parser.add_argument('--port', type=int, default=PORT, help='TCP port the devices connect to (default: %d)' % PORT)
+    parser.add_argument('--live-port', type=int, help='serve live positions over HTTP (and Server-Sent Events) on this local port')
+    parser.add_argument('--trace', type=int, default=0, metavar='N', help='print a trace of one packet out of N (default: no per-packet output)')
+    parser.add_argument('--metrics-interval', type=float, help='print a summary of the metrics every this many seconds')
+    parser.add_argument('--geofences', help='GeoJSON file of the fences (polygons, and points with a radius in metres) to report ENTER/EXIT events for')
+    parser.add_argument('--workers', type=int, nargs='?', const=workers.default_workers(), help='accept connections in this many worker processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    metrics.set_trace_sampling(args.trace)
+    serve(args.asyncio, args.workers, args.port, args.live_port, args.metrics_interval, args.geofences)
@@ -0,0 +1,179 @@
+"""
+Sessions of the connected devices.
+
+A session holds the little state the server keeps per connection, in a
+__slots__ object: the client (socket or AsyncClient), its address, the
+IMEI and software version reported at login, the latest GPS fix, and the
+outbox of the acks not written yet.
+
+Logged-in sessions are kept in a table keyed by IMEI, so that a device
+that reconnects replaces its former session (whose connection is shut
+down) instead of piling up a new entry, and entries are removed when
+their connection ends. Connections that never log in are not in the table.
+Memory per device thus stays constant however often devices reconnect.
+
+Stale connections (dead sockets without FIN) are closed by the connection
+handlers themselves, which read with LOGIN_TIMEOUT until the device logs
+in, and with HEARTBEAT_TIMEOUT afterwards.
+
+Acks are queued in the outbox of the session while the frames of a read are
+handled, then written at once. Once OUTBOX_HIGH_WATER bytes are queued, they
+are written before handling more frames. The handler stops reading from a
+device until its acks are written (TCP then holds the device back), and a
+device that reads none of them for WRITE_TIMEOUT seconds is disconnected.
+"""
+
+import socket
+import threading
+
+
+# Seconds a new connection has to send its login packet
+LOGIN_TIMEOUT = 60
+# Seconds without any packet (heartbeats included) after which a device is considered gone
+HEARTBEAT_TIMEOUT = 15 * 60
+# Bytes of acks queued for a device above which they are written at once
+# (also the limit of the asyncio transport buffer of a connection)
+OUTBOX_HIGH_WATER = 16 * 1024
+# Seconds a device may take to read its pending acks
+WRITE_TIMEOUT = 30
+
+
+class Session:
+    """
+    State of one device connection.
+    """
+    __slots__ = ('client', 'address', 'imei', 'software_version', 'gps', 'outbox')
+
+    def __init__(self, client, address):
+        self.client = client
+        self.address = address
+        self.imei = None
+        self.software_version = None
+        self.gps = {}
+        self.outbox = Outbox()
+
+    def read_timeout(self):
+        """
+        Seconds the next read may take before the connection is considered stale.
+        """
+        return(LOGIN_TIMEOUT if self.imei is None else HEARTBEAT_TIMEOUT)
+
+    def shutdown(self):
+        """
+        Shut the connection down, which wakes up its handler (blocked in a read),
+        which then closes it and ends the session.
+        """
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class Outbox:
+    """
+    Outbound bytes of one connection, written with as few send() calls as
+    the client accepts.
+    """
+    __slots__ = ('buffer',)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def put(self, data):
+        """
+        Queue data; returns whether the outbox reached OUTBOX_HIGH_WATER and should be flushed.
+        """
+        self.buffer += data
+        return(len(self.buffer) >= OUTBOX_HIGH_WATER)
+
+    def flush(self, client):
+        """
+        Write everything queued to the client, resuming after partial writes.
+        Returns the number of bytes written; if send() fails (e.g. times out),
+        the bytes not written stay queued.
+        """
+        data = bytes(self.buffer)
+        view = memoryview(data)
+        sent = 0
+        try:
+            while (sent < len(data)):
+                sent += client.send(view[sent:])
+        finally:
+            del self.buffer[:sent]
+        return(sent)
+
+    def __len__(self):
+        return(len(self.buffer))
+
+
+class SessionTable:
+    """
+    Logged-in sessions by IMEI, and open connections of the threaded server.
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.connections = set()
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.closed = threading.Condition(self.lock)
+
+    def connect(self, session):
+        """
+        Register a new connection; returns False once the server is stopping
+        (see shutdown_all), in which case the connection is to be closed.
+        """
+        with self.lock:
+            if (self.stopping):
+                return(False)
+            self.connections.add(session)
+            return(True)
+
+    def login(self, session, imei, software_version):
+        """
+        Register the session of a device that just logged in, and return the
+        session it replaces (already shut down), if any.
+        """
+        session.imei = imei
+        session.software_version = software_version
+        with self.lock:
+            former = self.sessions.get(imei)
+            self.sessions[imei] = session
+        if (former is session):
+            return(None)
+        if (former is not None):
+            former.shutdown()
+        return(former)
+
+    def close(self, session):
+        """
+        Remove a session whose connection ended (unless a newer one replaced it).
+        """
+        with self.lock:
+            if (self.sessions.get(session.imei) is session):
+                del self.sessions[session.imei]
+            self.connections.discard(session)
+            self.closed.notify_all()
+
+    def shutdown_all(self, timeout):
+        """
+        Refuse new connections, shut every open one down, and wait up to
+        timeout seconds for their handlers to close them.
+        Returns the number of connections still open.
+        """
+        with self.lock:
+            self.stopping = True
+            connections = list(self.connections)
+        for session in connections:
+            session.shutdown()
+        with self.lock:
+            self.closed.wait_for(lambda: not self.connections, timeout)
+            return(len(self.connections))
+
+    def get(self, imei):
+        with self.lock:
+            return(self.sessions.get(imei))
+
+    def __len__(self):
+        return(len(self.sessions))
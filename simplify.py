@@ -0,0 +1,192 @@
+"""
+Track simplification before rendering.
+
+Long histories are reduced to a bounded number of points before they are
+handed to folium, so that render time and HTML size do not depend on how
+long a device has been reporting:
+    - time-bucket decimation keeps one fix per bucket of N seconds,
+    - Douglas-Peucker or Visvalingam-Whyatt remove the points that do not
+      change the shape of the track by more than a tolerance, derived from
+      the zoom level (i.e. from the size of a pixel on the map),
+    - a point budget caps the result, by raising the tolerance as needed.
+
+All functions work on NumPy arrays and return the indices of the kept
+points, so that any column of the fixes can be selected with them.
+"""
+
+import numpy as np
+
+
+# Maximum number of points sent to the map by default
+POINT_BUDGET = 5000
+# Tolerance of the simplification, in screen pixels
+PIXEL_TOLERANCE = 1.0
+# No map is rendered at a finer zoom: a pixel there is the finest tolerance
+# searched for when fitting a budget
+FINEST_ZOOM = 22
+
+
+def tolerance_for_zoom(zoom, pixels=PIXEL_TOLERANCE):
+    """
+    Size, in degrees, of a number of pixels on a web map at a given zoom level
+    (tiles of 256 pixels, 360 degrees at zoom 0).
+    """
+    return(pixels * 360.0 / (256 * 2 ** zoom))
+
+
+def project(latitude, longitude):
+    """
+    Equirectangular projection around the mean latitude, so that distances
+    in both directions are in degrees of latitude.
+    """
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    scale = np.cos(np.radians(latitude.mean())) if len(latitude) else 1.0
+    return(longitude * scale, latitude)
+
+
+def decimate(times, bucket):
+    """
+    Keep the last fix of every time bucket of the given length (seconds).
+    """
+    times = np.asarray(times)
+    if (len(times) == 0):
+        return(np.arange(0))
+    buckets = times // bucket
+    # Last index of each run of identical buckets
+    return(np.nonzero(np.append(buckets[1:] != buckets[:-1], True))[0])
+
+
+def douglas_peucker(x, y, tolerance, limit=None):
+    """
+    Indices of the points kept by the Douglas-Peucker algorithm.
+    Each segment is processed with vectorized distance computations.
+    When limit is given, gives up as soon as more than limit points are kept
+    (the returned indices are then incomplete, but more than limit).
+    """
+    n = len(x)
+    if (n <= 2):
+        return(np.arange(n))
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    nbKept = 2
+    while (stack):
+        if (limit and nbKept > limit):
+            break
+        first, last = stack.pop()
+        if (last - first < 2):
+            continue
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        px = x[first + 1:last] - x[first]
+        py = y[first + 1:last] - y[first]
+        norm = np.hypot(dx, dy)
+        if (norm > 0):
+            distance = np.abs(dy * px - dx * py) / norm
+        else:
+            distance = np.hypot(px, py)
+        i = int(np.argmax(distance))
+        if (distance[i] > tolerance):
+            index = first + 1 + i
+            keep[index] = True
+            nbKept += 1
+            stack.append((first, index))
+            stack.append((index, last))
+    return(np.nonzero(keep)[0])
+
+
+def visvalingam(x, y, tolerance, limit=None):
+    """
+    Indices of the points kept by the Visvalingam-Whyatt algorithm, with an
+    area threshold of tolerance squared.
+    Points are removed in vectorized rounds: every point whose effective area
+    is below the threshold and is a local minimum is dropped, then the areas
+    of the remaining points are recomputed. Within a run of consecutive
+    minima (e.g. a parked device repeating the same fix, all of area 0),
+    every other point is dropped, so that a run is halved in each round.
+    limit is accepted for compatibility with douglas_peucker and ignored.
+    """
+    index = np.arange(len(x))
+    threshold = tolerance ** 2
+    while (len(index) > 2):
+        xs = x[index]
+        ys = y[index]
+        area = 0.5 * np.abs((xs[:-2] - xs[2:]) * (ys[1:-1] - ys[:-2]) - (xs[:-2] - xs[1:-1]) * (ys[2:] - ys[:-2]))
+        # Neighbours of removed points change area: only drop local minima
+        left = np.append(np.inf, area[:-1])
+        right = np.append(area[1:], np.inf)
+        candidates = (area < threshold) & (area <= left) & (area <= right)
+        if (not candidates.any()):
+            break
+        # Never two neighbours in the same round: keep every other candidate of a run
+        position = np.arange(len(candidates))
+        starts = candidates & ~np.append(False, candidates[:-1])
+        offset = position - np.maximum.accumulate(np.where(starts, position, 0))
+        remove = candidates & (offset % 2 == 0)
+        index = index[np.concatenate(([True], ~remove, [True]))]
+    return(index)
+
+
+methods = {
+    'douglas_peucker': douglas_peucker,
+    'visvalingam': visvalingam,
+}
+
+
+def simplify_track(latitude, longitude, times=None, zoom=None, budget=POINT_BUDGET, bucket=None, method='douglas_peucker'):
+    """
+    Indices of the fixes to render for a track.
+    Decimates by time buckets first (when bucket is given), then simplifies
+    with a tolerance no finer than the zoom level allows, and coarse enough
+    to leave no more than budget points. The first and last fixes are always kept.
+    """
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    selected = np.arange(len(latitude))
+    if (bucket and times is not None):
+        selected = decimate(times, bucket)
+    if (len(selected) <= 2):
+        return(selected)
+
+    x, y = project(latitude[selected], longitude[selected])
+    simplify = methods[method]
+    minimum = tolerance_for_zoom(zoom) if zoom is not None else 0.0
+    if (not budget or len(x) <= budget):
+        return(selected[simplify(x, y, minimum)] if minimum > 0 else selected)
+
+    # Simplification costs grow with the number of kept points: start coarse
+    # (about budget points along the track's extent) and refine the tolerance
+    # while the result fits in the budget, down to the zoom tolerance.
+    # Without zoom, the tolerance stays above a pixel at FINEST_ZOOM, so that
+    # it is never 0 (e.g. for a device that never moved)
+    minimum = max(minimum, tolerance_for_zoom(FINEST_ZOOM))
+    tolerance = max(max(np.ptp(x), np.ptp(y)) / budget, minimum)
+    kept = simplify(x, y, tolerance, budget)
+    while (len(kept) > budget):
+        tolerance *= 2
+        kept = simplify(x, y, tolerance, budget)
+    while (tolerance / 2 >= minimum and len(kept) < len(x)):
+        finer = simplify(x, y, tolerance / 2, budget)
+        if (len(finer) > budget):
+            break
+        kept = finer
+        tolerance /= 2
+    return(selected[kept])
+
+
+def simplify_records(records, zoom=None, budget=POINT_BUDGET, bucket=None, method='douglas_peucker'):
+    """
+    Simplify position store records (see position_store.load), track by track:
+    each device gets a share of the budget proportional to its number of fixes.
+    Returns the kept records, in their original order.
+    """
+    if (len(records) == 0):
+        return(records)
+    imeis, inverse = np.unique(records['imei'], return_inverse=True)
+    kept = []
+    for i in range(len(imeis)):
+        track = np.nonzero(inverse == i)[0]
+        share = max(2, budget * len(track) // len(records)) if budget else None
+        kept.append(track[simplify_track(records['latitude'][track], records['longitude'][track], records['time'][track], zoom, share, bucket, method)])
+    return(records[np.sort(np.concatenate(kept))])
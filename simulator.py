@@ -0,0 +1,356 @@
+"""
+zx303 device simulator and load benchmark.
+
+Opens N concurrent TCP sessions to a running server. Each session logs in
+with a synthetic IMEI, then sends GPS (0x10), heartbeat, status (0x13),
+time (0x30) and setup (0x57) packets at the configured intervals, plus
+optional bursts of offline GPS positions (0x11), as a device flushing its
+backlog would. Every response is checked against what the server is
+expected to answer, and its latency recorded.
+
+At the end, the run reports packets/sec, p50/p99 response latency and,
+when the server pid is given, its RSS and number of open file descriptors
+(including worker processes). Results can be saved as JSON and compared
+with a previous run.
+
+Usage:
+    python simulator.py --sessions 1000 --duration 60 --server-pid $(pgrep -of server.py) --save run.json
+    python simulator.py --sessions 1000 --duration 60 --compare run.json
+"""
+
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import time
+
+import codec
+import server
+
+
+# Latency and throughput changes reported as regressions beyond this ratio
+REGRESSION_THRESHOLD = 0.10
+# Tolerance on the datetime returned by the server (seconds)
+CLOCK_TOLERANCE = 5
+
+
+def login_packet(imei):
+    return(codec.make_content_response(0x01, bytes.fromhex('0' + imei) + b'\x01'))
+
+
+def gps_packet(protocol, dt, latitude, longitude, speed, heading):
+    """
+    GPS frame with the same layout as decoded by codec.decode_gps().
+    """
+    flags = 0x1000 | heading
+    if (latitude < 0):
+        flags |= 0x0800
+    if (longitude >= 0):
+        flags |= 0x0400
+    content = codec.GPS.pack(dt.year % 100, dt.month, dt.day, dt.hour, dt.minute, dt.second, 0xC0 | 9,
+                             int(abs(latitude) * codec.GPS_COORDINATE_DIVISOR), int(abs(longitude) * codec.GPS_COORDINATE_DIVISOR),
+                             speed, flags)
+    return(codec.make_content_response(protocol, content))
+
+
+STATUS_PACKET = codec.make_content_response(0x13, bytes([100, 1, 20, 3, 0, 0]))
+HEARTBEAT_PACKET = codec.make_content_response(0x08)
+TIME_PACKET = codec.make_content_response(0x30)
+SETUP_PACKET = codec.make_content_response(0x57)
+
+
+def datetime_is_current(content, truncatedYear):
+    """
+    Check that the datetime content of a response is the current UTC time.
+    """
+    if (truncatedYear):
+        fields = codec.DATETIME_SHORT.unpack(content)
+        fields = (2000 + fields[0],) + fields[1:]
+    else:
+        fields = codec.DATETIME_LONG.unpack(content)
+    try:
+        dt = datetime(*fields)
+    except ValueError:
+        return(False)
+    return(abs((dt - datetime.utcnow()).total_seconds()) <= CLOCK_TOLERANCE)
+
+
+def expect_exact(expected):
+    return(lambda frame: frame == expected)
+
+
+def expect_datetime(protocol, truncatedYear):
+    size = codec.DATETIME_SHORT.size if truncatedYear else codec.DATETIME_LONG.size
+    return(lambda frame: (len(frame) == size + 6 and frame[codec.PROTOCOL_OFFSET] == protocol
+                          and datetime_is_current(frame[codec.CONTENT_OFFSET:-2], truncatedYear)))
+
+
+# Expected responses; status packets are not answered by the server
+expectations = {
+    'login': expect_exact(codec.make_content_response(0x01, b'\x01')),
+    'gps': expect_datetime(0x10, truncatedYear=True),
+    'gps_offline': expect_datetime(0x11, truncatedYear=True),
+    'heartbeat': expect_exact(codec.make_content_response(0x08)),
+    'time': expect_datetime(0x30, truncatedYear=False),
+    # Simulated devices have no setup of their own: they get the server defaults
+    'setup': expect_exact(codec.make_content_response(0x57, codec.encode_setup(**server.setup_defaults))),
+    'status': None,
+}
+
+
+class Stats:
+    """
+    Counters and latencies of a whole run.
+    """
+
+    def __init__(self):
+        self.sent = collections.Counter()
+        self.received = collections.Counter()
+        self.mismatches = collections.Counter()
+        self.latencies = []
+        self.errors = 0
+        self.connected = 0
+
+
+class Session:
+    """
+    One simulated device.
+    """
+
+    def __init__(self, number, args, stats):
+        self.imei = '35%013d' % number
+        self.args = args
+        self.stats = stats
+        self.pending = collections.deque()
+        self.latitude = 52.2297 + random.uniform(-0.1, 0.1)
+        self.longitude = 21.0122 + random.uniform(-0.1, 0.1)
+
+    def next_position(self, dt):
+        self.latitude += random.uniform(-0.0005, 0.0005)
+        self.longitude += random.uniform(-0.0005, 0.0005)
+        return(dt, self.latitude, self.longitude, random.randint(0, 60), random.randint(0, 359))
+
+    def send(self, writer, kind, data, count=1):
+        """
+        Write packets and remember which responses they expect, in order.
+        """
+        now = time.perf_counter()
+        writer.write(data)
+        self.stats.sent[kind] += count
+        if (expectations[kind] is not None):
+            for i in range(count):
+                self.pending.append((kind, now))
+
+    async def read_responses(self, reader):
+        frames = codec.FrameBuffer()
+        while (True):
+            data = await reader.read(65536)
+            if (not data):
+                return
+            now = time.perf_counter()
+            for frame in frames.feed(data):
+                if (not self.pending):
+                    self.stats.mismatches['unexpected'] += 1
+                    continue
+                kind, sent = self.pending.popleft()
+                self.stats.received[kind] += 1
+                self.stats.latencies.append(now - sent)
+                if (not expectations[kind](frame)):
+                    self.stats.mismatches[kind] += 1
+
+    async def run(self, deadline):
+        args = self.args
+        await asyncio.sleep(random.uniform(0, args.ramp))
+        try:
+            reader, writer = await asyncio.open_connection(args.host, args.port)
+        except OSError:
+            self.stats.errors += 1
+            return
+        self.stats.connected += 1
+        responses = asyncio.ensure_future(self.read_responses(reader))
+        self.send(writer, 'login', login_packet(self.imei))
+
+        # Next due time of every periodic packet, spread randomly over its first interval
+        now = time.monotonic()
+        schedule = {kind: now + random.uniform(0, interval) for kind, interval in self.intervals().items() if interval > 0}
+        try:
+            while (schedule):
+                kind, due = min(schedule.items(), key=lambda item: item[1])
+                if (due >= deadline):
+                    break
+                await asyncio.sleep(max(due - time.monotonic(), 0))
+                self.send_periodic(writer, kind)
+                schedule[kind] = due + self.intervals()[kind]
+                await writer.drain()
+            # Leave time for the last responses
+            await asyncio.sleep(args.grace)
+        except OSError:
+            self.stats.errors += 1
+        finally:
+            responses.cancel()
+            writer.close()
+
+    def intervals(self):
+        args = self.args
+        return({
+            'gps': args.gps_interval,
+            'heartbeat': args.heartbeat_interval,
+            'status': args.status_interval,
+            'time': args.time_interval,
+            'setup': args.setup_interval,
+            'gps_offline': args.burst_interval,
+        })
+
+    def send_periodic(self, writer, kind):
+        now = datetime.utcnow()
+        if (kind == 'gps'):
+            self.send(writer, kind, gps_packet(0x10, *self.next_position(now)))
+        elif (kind == 'gps_offline'):
+            # Backlog of positions recorded while offline, flushed in a single write
+            size = self.args.burst_size
+            burst = b''.join(gps_packet(0x11, *self.next_position(now - timedelta(minutes=size - i))) for i in range(size))
+            self.send(writer, kind, burst, size)
+        elif (kind == 'heartbeat'):
+            self.send(writer, kind, HEARTBEAT_PACKET)
+        elif (kind == 'status'):
+            self.send(writer, kind, STATUS_PACKET)
+        elif (kind == 'time'):
+            self.send(writer, kind, TIME_PACKET)
+        elif (kind == 'setup'):
+            self.send(writer, kind, SETUP_PACKET)
+
+
+def process_tree(pid):
+    """
+    pid and the pids of all its descendants (e.g. worker processes).
+    """
+    pids = [pid]
+    for tid in os.listdir('/proc/%d/task' % pid):
+        try:
+            with open('/proc/%d/task/%s/children' % (pid, tid)) as children:
+                for child in children.read().split():
+                    pids.extend(process_tree(int(child)))
+        except OSError:
+            pass
+    return(pids)
+
+
+def server_resources(pid):
+    """
+    Total RSS (kB) and number of open file descriptors of the server processes.
+    """
+    rss = 0
+    fds = 0
+    for p in process_tree(pid):
+        try:
+            with open('/proc/%d/status' % p) as status:
+                for line in status:
+                    if (line.startswith('VmRSS:')):
+                        rss += int(line.split()[1])
+            fds += len(os.listdir('/proc/%d/fd' % p))
+        except OSError:
+            pass
+    return(rss, fds)
+
+
+def percentile(values, fraction):
+    if (not values):
+        return(None)
+    return(values[min(int(fraction * len(values)), len(values) - 1)])
+
+
+async def simulate(args):
+    stats = Stats()
+    start = time.monotonic()
+    deadline = start + args.duration
+    sessions = [Session(n, args, stats) for n in range(args.sessions)]
+    peak = (0, 0)
+    tasks = [asyncio.ensure_future(session.run(deadline)) for session in sessions]
+    # Sample the server resources while the sessions are open
+    while (not all(task.done() for task in tasks)):
+        await asyncio.sleep(1)
+        if (args.server_pid):
+            rss, fds = server_resources(args.server_pid)
+            peak = (max(peak[0], rss), max(peak[1], fds))
+    elapsed = time.monotonic() - start - args.grace
+
+    latencies = sorted(stats.latencies)
+    return({
+        'date': datetime.now().strftime('%Y/%m/%d %H:%M:%S'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('save', 'compare')},
+        'connected': stats.connected,
+        'errors': stats.errors,
+        'sent': dict(stats.sent),
+        'received': dict(stats.received),
+        'mismatches': dict(stats.mismatches),
+        'missing': sum(stats.sent[k] for k in stats.sent if expectations[k] is not None) - sum(stats.received.values()),
+        'packets_per_sec': sum(stats.sent.values()) / elapsed,
+        'responses_per_sec': sum(stats.received.values()) / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'server_rss_kb': peak[0] or None,
+        'server_fds': peak[1] or None,
+    })
+
+
+def report(result):
+    print('Sessions  : %d connected, %d errors' % (result['connected'], result['errors']))
+    print('Sent      : %s' % result['sent'])
+    print('Mismatches: %s, missing responses: %d' % (result['mismatches'], result['missing']))
+    print('Throughput: %.0f packets/sec sent, %.0f responses/sec' % (result['packets_per_sec'], result['responses_per_sec']))
+    if (result['latency_p50_ms'] is not None):
+        print('Latency   : p50 %.2f ms, p99 %.2f ms' % (result['latency_p50_ms'], result['latency_p99_ms']))
+    if (result['server_rss_kb']):
+        print('Server    : %d kB RSS, %d open fds (peak)' % (result['server_rss_kb'], result['server_fds']))
+
+
+def compare(result, previous):
+    """
+    Print the changes from a previous run, flagging regressions.
+    Higher is better for throughput, lower is better for the others.
+    """
+    metrics = [('responses_per_sec', True), ('latency_p50_ms', False), ('latency_p99_ms', False), ('server_rss_kb', False), ('server_fds', False)]
+    regressions = 0
+    for name, higherIsBetter in metrics:
+        old, new = previous.get(name), result.get(name)
+        if (not old or new is None):
+            continue
+        change = (new - old) / old
+        regression = (change < -REGRESSION_THRESHOLD) if higherIsBetter else (change > REGRESSION_THRESHOLD)
+        regressions += regression
+        print('%-18s %12.2f -> %12.2f (%+.1f%%)%s' % (name, old, new, change * 100, '  REGRESSION' if regression else ''))
+    return(regressions)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='zx303 device simulator and load benchmark')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=60000)
+    parser.add_argument('--sessions', type=int, default=100, help='number of concurrent devices')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of traffic')
+    parser.add_argument('--ramp', type=float, default=5, help='seconds over which sessions connect')
+    parser.add_argument('--grace', type=float, default=2, help='seconds to wait for the last responses')
+    parser.add_argument('--gps-interval', type=float, default=10, help='seconds between GPS packets (0 to disable)')
+    parser.add_argument('--heartbeat-interval', type=float, default=60)
+    parser.add_argument('--status-interval', type=float, default=300)
+    parser.add_argument('--time-interval', type=float, default=600)
+    parser.add_argument('--setup-interval', type=float, default=3600)
+    parser.add_argument('--burst-interval', type=float, default=0, help='seconds between offline backlog bursts (0 to disable)')
+    parser.add_argument('--burst-size', type=int, default=100, help='offline GPS packets per burst')
+    parser.add_argument('--server-pid', type=int, help='pid of the server, to report its RSS and open fds')
+    parser.add_argument('--save', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results saved in this JSON file')
+    args = parser.parse_args()
+
+    result = asyncio.run(simulate(args))
+    report(result)
+    if (args.save):
+        with open(args.save, 'w') as output:
+            json.dump(result, output, indent=2)
+    if (args.compare):
+        with open(args.compare) as previous:
+            if (compare(result, json.load(previous))):
+                raise SystemExit(1)
@@ -0,0 +1,124 @@
+"""
+Datetime handling of the hot path.
+
+Times are kept as epoch seconds internally, and only formatted to local
+'YYYY/MM/DD HH:MM:SS' strings when written out (logs, live JSON):
+    - GPS datetimes are computed straight from their YY MM DD HH MM SS
+      integer fields, without any string parsing,
+    - UTC to local offsets are looked up once per hour and cached,
+    - the same conversions run vectorized over numpy arrays, for the
+      ingestion of backlogs (numpy is only imported by these).
+"""
+
+import time
+
+
+SECONDS_PER_DAY = 86400
+SECONDS_PER_HOUR = 3600
+LOCAL_FORMAT = '%04d/%02d/%02d %02d:%02d:%02d'
+
+# UTC to local offset (seconds) of each UTC hour since the epoch
+utc_offsets = {}
+# Offset to subtract from local wall-clock times, by local hour since the epoch
+local_offsets = {}
+
+
+def days_from_civil(year, month, day):
+    """
+    Days since 1970-01-01 of a proleptic Gregorian date.
+    Only uses integer arithmetic, so that it works on ints as on numpy arrays.
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + 12 * (month <= 2) - 3) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return(era * 146097 + doe - 719468)
+
+
+def epoch_from_fields(fields):
+    """
+    Epoch seconds of GPS datetime fields (YY, MM, DD, HH, MM, SS) at UTC,
+    or None if the device did not send any (all zeros).
+    """
+    yy, mo, dd, hh, mi, ss = fields
+    if (not mo):
+        return(None)
+    return(days_from_civil(2000 + yy, mo, dd) * SECONDS_PER_DAY + hh * SECONDS_PER_HOUR + mi * 60 + ss)
+
+
+def epochs_from_fields(fields):
+    """
+    Vectorized epoch_from_fields over an (n, 6) array of GPS datetime fields.
+    Rows without a datetime (zero month) come out as -1.
+    """
+    import numpy as np
+    fields = np.asarray(fields, dtype=np.int64)
+    yy, mo, dd, hh, mi, ss = fields.T
+    epochs = days_from_civil(2000 + yy, mo, dd) * SECONDS_PER_DAY + hh * SECONDS_PER_HOUR + mi * 60 + ss
+    return(np.where(mo > 0, epochs, -1))
+
+
+def utc_offset(epoch):
+    """
+    Offset of the local timezone at an epoch time, cached per hour.
+    """
+    hour = int(epoch) // SECONDS_PER_HOUR
+    offset = utc_offsets.get(hour)
+    if (offset is None):
+        offset = time.localtime(hour * SECONDS_PER_HOUR).tm_gmtoff
+        utc_offsets[hour] = offset
+    return(offset)
+
+
+def format_local(epoch):
+    """
+    Local 'YYYY/MM/DD HH:MM:SS' string of an epoch time.
+    """
+    epoch = int(epoch)
+    return(LOCAL_FORMAT % time.gmtime(epoch + utc_offset(epoch))[:6])
+
+
+def local_offset(localHour):
+    """
+    Offset to subtract from a local wall-clock time to get epoch seconds,
+    given its hour counted as if it were UTC. Cached per hour.
+    """
+    offset = local_offsets.get(localHour)
+    if (offset is None):
+        offset = localHour * SECONDS_PER_HOUR - int(time.mktime(time.gmtime(localHour * SECONDS_PER_HOUR)[:8] + (-1,)))
+        local_offsets[localHour] = offset
+    return(offset)
+
+
+def parse_local(value):
+    """
+    Epoch seconds of a local 'YYYY/MM/DD HH:MM:SS' string.
+    """
+    wall = days_from_civil(int(value[0:4]), int(value[5:7]), int(value[8:10])) * SECONDS_PER_DAY + \
+        int(value[11:13]) * SECONDS_PER_HOUR + int(value[14:16]) * 60 + int(value[17:19])
+    return(wall - local_offset(wall // SECONDS_PER_HOUR))
+
+
+def parse_local_array(values):
+    """
+    Vectorized parse_local over a sequence of 'YYYY/MM/DD HH:MM:SS' strings:
+    digits are read straight from the bytes, and offsets looked up once per
+    distinct hour.
+    """
+    import numpy as np
+    if (not len(values)):
+        return(np.empty(0, dtype=np.int64))
+    digits = np.frombuffer(''.join(values).encode('ascii'), dtype=np.uint8).reshape(-1, 19).astype(np.int64) - ord('0')
+
+    def number(first, last):
+        n = digits[:, first]
+        for column in range(first + 1, last):
+            n = n * 10 + digits[:, column]
+        return(n)
+
+    wall = days_from_civil(number(0, 4), number(5, 7), number(8, 10)) * SECONDS_PER_DAY + \
+        number(11, 13) * SECONDS_PER_HOUR + number(14, 16) * 60 + number(17, 19)
+    hours, inverse = np.unique(wall // SECONDS_PER_HOUR, return_inverse=True)
+    offsets = np.array([local_offset(int(hour)) for hour in hours], dtype=np.int64)
+    return(wall - offsets[inverse])
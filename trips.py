@@ -0,0 +1,284 @@
+"""
+Distance travelled, stops and trips of each device.
+
+Fixes of a device are taken in the order they arrive, skipping those that
+are not newer than the latest one (late offline positions). Each step from
+one fix to the next is measured with the haversine distance, and:
+    - a still step moves less than STOP_RADIUS metres,
+    - a run of consecutive still steps lasting STOP_DURATION seconds or more
+      is a stop (the device dwells there),
+    - a step over more than GAP_DURATION seconds (device off or out of
+      coverage) also separates trips.
+A trip is what lies between two stops: from the last fix of a stop to the
+first fix of the next one, with the sum of its step distances.
+
+TripTracker applies these rules incrementally, as each fix arrives, with a
+small constant state per device, and keeps the last TRIP_HISTORY trips of
+each device, so that summaries are served without reading any fix again.
+segment() applies the very same rules to whole arrays of fixes with NumPy,
+to recompute everything from the position store.
+
+Usage: python trips.py [--store logs/positions] [--imei IMEI] [--save trips.json]
+"""
+
+import argparse
+import collections
+import json
+import threading
+
+import position_store
+import timestamps
+from geofence import haversine, EARTH_RADIUS
+
+
+# Metres a device may drift while it is considered still
+STOP_RADIUS = 50
+# Seconds of stillness that make a stop
+STOP_DURATION = 5 * 60
+# Seconds between two fixes that end a trip (must not be below STOP_DURATION)
+GAP_DURATION = 30 * 60
+# Completed trips kept per device
+TRIP_HISTORY = 100
+
+
+def trip_summary(start, stop, distance):
+    """
+    Summary of a trip, from its first and last fixes (time, latitude, longitude)
+    and its distance in metres.
+    """
+    duration = stop[0] - start[0]
+    return({
+        'start': timestamps.format_local(start[0]),
+        'stop': timestamps.format_local(stop[0]),
+        'start_latitude': start[1],
+        'start_longitude': start[2],
+        'stop_latitude': stop[1],
+        'stop_longitude': stop[2],
+        'distance': round(distance, 1),
+        'duration': duration,
+        'speed': round(distance / duration * 3.6, 1) if duration > 0 else 0.0
+    })
+
+
+class DeviceTrips:
+    """
+    Running state of one device.
+    """
+    __slots__ = ('last', 'odometer', 'stopped', 'tripStart', 'tripDistance', 'tripSteps',
+                 'runStart', 'runDistance', 'runSteps', 'trips')
+
+    def __init__(self, fix):
+        # Fixes are (time, latitude, longitude)
+        self.last = fix
+        self.odometer = 0.0
+        # Whether the device is in a stop; otherwise a trip started at tripStart
+        self.stopped = False
+        self.tripStart = fix
+        self.tripDistance = 0.0
+        self.tripSteps = 0
+        # First fix of the current run of still steps, if any
+        self.runStart = None
+        self.runDistance = 0.0
+        self.runSteps = 0
+        self.trips = collections.deque(maxlen=TRIP_HISTORY)
+
+    def update(self, fix):
+        """
+        Account for a new fix. Returns the summary of the trip it completes, if any.
+        """
+        previous = self.last
+        if (fix[0] <= previous[0]):
+            return(None)
+        self.last = fix
+        distance = haversine(previous[1], previous[2], fix[1], fix[2])
+        self.odometer += distance
+        still = distance <= STOP_RADIUS
+        completed = None
+
+        if (fix[0] - previous[0] > GAP_DURATION and not still):
+            # The trip (if any) ended with the previous fix, and another may start here
+            if (not self.stopped and self.tripSteps):
+                completed = trip_summary(self.tripStart, previous, self.tripDistance)
+            self.stopped = False
+            self.tripStart = fix
+            self.tripDistance = 0.0
+            self.tripSteps = 0
+            self.runStart = None
+
+        elif (still):
+            if (self.runStart is None):
+                self.runStart = previous
+                self.runDistance = 0.0
+                self.runSteps = 0
+            self.runDistance += distance
+            self.runSteps += 1
+            if (not self.stopped):
+                self.tripDistance += distance
+                self.tripSteps += 1
+                if (fix[0] - self.runStart[0] >= STOP_DURATION):
+                    # The run is a stop: the trip ended where it began
+                    if (self.tripSteps > self.runSteps):
+                        completed = trip_summary(self.tripStart, self.runStart, self.tripDistance - self.runDistance)
+                    self.stopped = True
+
+        else:
+            self.runStart = None
+            if (self.stopped):
+                # Departure: the trip starts at the last fix of the stop
+                self.stopped = False
+                self.tripStart = previous
+                self.tripDistance = distance
+                self.tripSteps = 1
+            else:
+                self.tripDistance += distance
+                self.tripSteps += 1
+
+        if (completed is not None):
+            self.trips.append(completed)
+        return(completed)
+
+    def summary(self):
+        """
+        Odometer, current state and last trips of the device.
+        """
+        current = None
+        if (not self.stopped and self.tripSteps):
+            current = trip_summary(self.tripStart, self.last, self.tripDistance)
+        return({
+            'odometer': round(self.odometer, 1),
+            'stopped': self.stopped,
+            'stopped_since': timestamps.format_local(self.runStart[0]) if self.stopped else None,
+            'last_fix': timestamps.format_local(self.last[0]),
+            'current_trip': current,
+            'trips': list(self.trips)
+        })
+
+
+class TripTracker:
+    """
+    DeviceTrips of every device, updated by the server on each valid fix.
+    Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def update(self, imei, fixTime, latitude, longitude):
+        fix = (fixTime, latitude, longitude)
+        with self.lock:
+            device = self.devices.get(imei)
+            if (device is None):
+                self.devices[imei] = DeviceTrips(fix)
+                return(None)
+            return(device.update(fix))
+
+    def summary(self, imei=None):
+        """
+        Summary of one device (None if unknown), or of every device by IMEI.
+        """
+        with self.lock:
+            if (imei is not None):
+                device = self.devices.get(imei)
+                return(device.summary() if device is not None else None)
+            return({imei: device.summary() for imei, device in self.devices.items()})
+
+
+def haversine_array(lat1, lon1, lat2, lon2):
+    """
+    Vectorized haversine(), in metres.
+    """
+    import numpy as np
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lon2 - lon1) / 2) ** 2
+    return(2 * EARTH_RADIUS * np.arcsin(np.sqrt(a)))
+
+
+def runs(mask):
+    """
+    (first, last) indices of the runs of True values of a boolean array.
+    """
+    import numpy as np
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1)
+
+
+def segment(times, latitudes, longitudes):
+    """
+    Batch counterpart of DeviceTrips: the same rules, applied with NumPy to
+    all the fixes of a device (in arrival order). Returns the same summary.
+    """
+    import numpy as np
+    times = np.asarray(times, dtype=np.int64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    if (len(times) == 0):
+        return(None)
+    # Only fixes newer than every previous one are used
+    keep = np.concatenate(([True], times[1:] > np.maximum.accumulate(times)[:-1]))
+    times, latitudes, longitudes = times[keep], latitudes[keep], longitudes[keep]
+    fix = lambda i: (int(times[i]), float(latitudes[i]), float(longitudes[i]))
+
+    # Step i goes from fix i to fix i + 1
+    distances = haversine_array(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+    still = distances <= STOP_RADIUS
+    gaps = (np.diff(times) > GAP_DURATION) & ~still
+
+    # Stops: runs of still steps lasting at least STOP_DURATION
+    stopSteps = gaps.copy()
+    lastStop = None
+    for first, last in zip(*runs(still)):
+        if (times[last + 1] - times[first] >= STOP_DURATION):
+            stopSteps[first:last + 1] = True
+            lastStop = (first, last)
+
+    # Trips: runs of the other steps; the last one is in progress unless a stop follows
+    cumulative = np.concatenate(([0.0], np.cumsum(distances)))
+    trips = []
+    current = None
+    for first, last in zip(*runs(~stopSteps)):
+        summary = trip_summary(fix(first), fix(last + 1), float(cumulative[last + 1] - cumulative[first]))
+        if (last == len(distances) - 1):
+            current = summary
+        else:
+            trips.append(summary)
+
+    stopped = bool(len(distances)) and bool(stopSteps[-1]) and not gaps[-1]
+    return({
+        'odometer': round(float(cumulative[-1]), 1),
+        'stopped': stopped,
+        'stopped_since': timestamps.format_local(times[lastStop[0]]) if stopped else None,
+        'last_fix': timestamps.format_local(times[-1]),
+        'current_trip': current,
+        'trips': trips[-TRIP_HISTORY:]
+    })
+
+
+def segment_store(directory, imei=None):
+    """
+    Summaries of one device, or of every device of a position store, by IMEI.
+    """
+    summaries = {}
+    for device in ([imei] if imei else position_store.devices(directory)):
+        records = position_store.load(directory, device)
+        records = records[records['valid'] == 1]
+        summary = segment(records['time'], records['latitude'], records['longitude'])
+        if (summary is not None):
+            summaries[str(device)] = summary
+    return(summaries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='trips and distances of the devices, from the position store')
+    parser.add_argument('--store', default=position_store.DEFAULT_DIRECTORY, help='position store directory')
+    parser.add_argument('--imei', help='only this device')
+    parser.add_argument('--save', help='write the summaries to this JSON file')
+    args = parser.parse_args()
+
+    summaries = segment_store(args.store, args.imei)
+    for imei, summary in summaries.items():
+        print(imei, ': %.1f km,' % (summary['odometer'] / 1000), len(summary['trips']), 'trips,', 'stopped since ' + summary['stopped_since'] if summary['stopped'] else 'moving')
+    if (args.save):
+        with open(args.save, 'w') as output:
+            json.dump(summaries, output, indent=1)
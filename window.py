@@ -1,26 +1,103 @@
 import io
+import json
 import sys
 
 import folium
-import pandas as pd
+from branca.element import MacroElement
+from jinja2 import Template
+
+import position_store
 
 from PyQt5 import QtCore, QtGui, QtWidgets, QtWebEngineWidgets
 
 
-class Window(QtWidgets.QMainWindow):
+# Interval of the automatic refresh, in milliseconds
+AUTO_REFRESH_INTERVAL = 5000
+
+
+class TrackLayer(MacroElement):
+    """
+    Empty GeoJSON layer added to the map, along with a global
+    addTrackPoints(geojson, center) function used to push new fixes
+    into the page that is already loaded, instead of reloading it.
+    """
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        var track_layer = L.geoJSON(null, {
+            pointToLayer: function (feature, latlng) {
+                return L.circleMarker(latlng, {radius: 3, weight: 2, color: 'red', fillColor: 'red', fillOpacity: 0.5});
+            }
+        }).addTo({{ this._parent.get_name() }});
+        window.addTrackPoints = function (geojson, center) {
+            track_layer.addData(geojson);
+            if (center) {
+                {{ this._parent.get_name() }}.setView(center, 13);
+            }
+        };
+        {% endmacro %}
+        """)
+
     def __init__(self):
         super().__init__()
+        self._name = 'TrackLayer'
+
+
+class TailSignals(QtCore.QObject):
+    # New GeoJSON points, last position (or None) and updated offsets per device
+    done = QtCore.pyqtSignal(object, object, object)
+
+
+class TailTask(QtCore.QRunnable):
+    """
+    Reads the fixes appended to the position store since the previous refresh
+    and converts them into GeoJSON, away from the UI thread.
+    """
+
+    def __init__(self, imei, start, stop, offsets):
+        super().__init__()
+        self.imei = imei
+        self.start = start
+        self.stop = stop
+        self.offsets = dict(offsets)
+        self.signals = TailSignals()
+
+    def run(self):
+        directory = position_store.DEFAULT_DIRECTORY
+        coordinates = []
+        last = None
+        for imei in ([self.imei] if self.imei else position_store.devices(directory)):
+            records, self.offsets[imei] = position_store.tail(directory, imei, self.offsets.get(imei, 0), self.start, self.stop)
+            if (len(records) > 0):
+                coordinates.extend(zip(records['longitude'].tolist(), records['latitude'].tolist()))
+                last = [float(records['latitude'][-1]), float(records['longitude'][-1])]
+        geojson = {'type': 'MultiPoint', 'coordinates': coordinates} if coordinates else None
+        self.signals.done.emit(geojson, last, self.offsets)
+
+
+class Window(QtWidgets.QMainWindow):
+    def __init__(self, imei=None, start=None, stop=None):
+        super().__init__()
+        # Device and time range (epoch seconds) to display; None means everything
+        self.imei = imei
+        self.start = start
+        self.stop = stop
+        # Number of records of each device already pushed to the map
+        self.offsets = {}
+        self.refreshing = False
+        self.pageLoaded = False
+        self.pending = []
         self.initWindow()
 
     def initWindow(self):
         self.setWindowTitle(self.tr("MAP PROJECT"))
         self.buttonUI()
-        self.showMaximized() 
+        self.showMaximized()
 
     def buttonUI(self):
         shortPathButton = QtWidgets.QPushButton(self.tr("Refresh map"))
         shortPathButton.setFixedSize(120, 50)
-        
+        autoRefreshBox = QtWidgets.QCheckBox(self.tr("Auto refresh"))
+
 
         self.view = QtWebEngineWidgets.QWebEngineView()
         self.view.setContentsMargins(50, 50, 50, 50)
@@ -34,33 +111,67 @@ class Window(QtWidgets.QMainWindow):
         vlay.setSpacing(20)
         vlay.addStretch()
         vlay.addWidget(shortPathButton)
-        
+        vlay.addWidget(autoRefreshBox)
+
         vlay.addStretch()
         lay.addWidget(button_container)
         lay.addWidget(self.view, stretch=1)
-        #read data and show location on map
-           
+        #load the map page once: new locations are then pushed into it
+
         m = folium.Map(location=[52.227830, 21.001819], zoom_start=13)
+        TrackLayer().add_to(m)
         data = io.BytesIO()
         m.save(data, close_file=False)
+        self.view.loadFinished.connect(self.pageFinished)
         self.view.setHtml(data.getvalue().decode())
-        
+
         shortPathButton.clicked.connect(self.refresh)
-        
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        autoRefreshBox.toggled.connect(self.setAutoRefresh)
+
+    def setAutoRefresh(self, enabled):
+        if (enabled):
+            self.timer.start(AUTO_REFRESH_INTERVAL)
+            self.refresh()
+        else:
+            self.timer.stop()
+
+    def pageFinished(self, ok):
+        self.pageLoaded = ok
+        # Push points that were read while the page was still loading
+        for geojson, center in self.pending:
+            self.addPoints(geojson, center)
+        self.pending = []
+
     def refresh(self):
-        df = pd.read_csv('logs/location_log.txt', header=None,sep='	')
-            
-        m = folium.Map(location=[df[7][-1:],df[8][-1:]], zoom_start=13)
-        for i,row in df.iterrows():
-            folium.CircleMarker((df[7][i],df[8][i]), radius=3, weight=2, color='red', fill_color='red', fill_opacity=.5).add_to(m)
-        data = io.BytesIO()
-        m.save(data, close_file=False)
-        self.view.setHtml(data.getvalue().decode())
-        
+        # Only one read at a time: a slow read must not pile up with the timer
+        if (self.refreshing):
+            return
+        self.refreshing = True
+        task = TailTask(self.imei, self.start, self.stop, self.offsets)
+        task.signals.done.connect(self.refreshed)
+        QtCore.QThreadPool.globalInstance().start(task)
+
+    def refreshed(self, geojson, last, offsets):
+        self.refreshing = False
+        # Center the map on the latest position the first time points are shown
+        center = last if (not any(self.offsets.values())) else None
+        self.offsets = offsets
+        if (geojson is None):
+            return
+        if (self.pageLoaded):
+            self.addPoints(geojson, center)
+        else:
+            self.pending.append((geojson, center))
+
+    def addPoints(self, geojson, center):
+        self.view.page().runJavaScript('addTrackPoints(%s, %s);' % (json.dumps(geojson), json.dumps(center)))
+
 if __name__ == "__main__":
     App = QtWidgets.QApplication(sys.argv)
-    window = Window()
+    # Optional IMEI to display a single device
+    window = Window(sys.argv[1] if len(sys.argv) > 1 else None)
     window.show()
     sys.exit(App.exec())
-    
 
@@ -0,0 +1,188 @@
+"""
+Helpers for the multi-process mode of the server.
+
+Each worker process accepts and serves its own devices, keeping their
+session state local. Everything that must end up in a single place (log
+lines, fixes for the position store, live positions, trip analytics,
+snapshots of the metrics) is funneled to the parent process through a
+multiprocessing queue, in batches, and written there by the usual
+LogWriter / PositionStore / LiveTable.
+"""
+
+import os
+import socket
+import threading
+import time
+
+
+# Items are sent to the parent once this many are pending, or after this delay (seconds)
+FUNNEL_BATCH = 256
+FUNNEL_INTERVAL = 0.2
+# Workers report their metrics to the parent every this many seconds
+METRICS_INTERVAL = 1.0
+
+
+def reuse_port_available():
+    return(hasattr(socket, 'SO_REUSEPORT'))
+
+
+def reuse_port_socket(address, backlog):
+    """
+    Listening socket bound with SO_REUSEPORT: every worker binds its own,
+    and the kernel balances incoming connections between them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return(sock)
+
+
+class Funnel:
+    """
+    Batches (kind, args) items and sends them to the parent process queue
+    from a background thread.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.items = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        threading.Thread(target=self.run, name='Funnel', daemon=True).start()
+
+    def put(self, kind, *args):
+        with self.lock:
+            # Items of a handler that outlived the stop of its worker are dropped
+            if (self.closed.is_set()):
+                return
+            self.items.append((kind, args))
+            full = len(self.items) >= FUNNEL_BATCH
+        if (full):
+            self.flush()
+
+    def flush(self):
+        # Under the lock, so that no batch is sent once close() closed the queue
+        # (queue.put() does not block: batches are sent by its feeder thread)
+        with self.lock:
+            items, self.items = self.items, []
+            if (items and not self.closed.is_set()):
+                self.queue.put(items)
+
+    def run(self):
+        while (not self.closed.wait(FUNNEL_INTERVAL)):
+            self.flush()
+
+    def close(self):
+        """
+        Send the last items and wait until they are handed over to the parent.
+        The connection handlers are to be stopped first: later items are dropped.
+        """
+        with self.lock:
+            items, self.items = self.items, []
+            if (items):
+                self.queue.put(items)
+            self.closed.set()
+            self.queue.close()
+        self.queue.join_thread()
+
+
+class FunnelLogWriter:
+    """
+    Stands for the LogWriter of a file in a worker process.
+    """
+
+    def __init__(self, funnel, filename):
+        self.funnel = funnel
+        self.filename = filename
+
+    def write(self, line):
+        self.funnel.put('log', self.filename, line)
+
+    def close(self):
+        self.funnel.flush()
+
+
+class FunnelPositionStore:
+    """
+    Stands for the PositionStore in a worker process.
+    """
+
+    def __init__(self, funnel):
+        self.funnel = funnel
+
+    def append(self, *fix):
+        self.funnel.put('fix', *fix)
+
+    def write_array(self, imei, records):
+        self.funnel.put('fixes', imei, records)
+
+    def close(self):
+        self.funnel.flush()
+
+
+class FunnelLiveTable:
+    """
+    Stands for the LiveTable in a worker process: the table itself,
+    and the HTTP endpoint serving it, live in the parent.
+    """
+
+    def __init__(self, funnel):
+        self.funnel = funnel
+
+    def publish(self, imei, fix):
+        self.funnel.put('live', imei, dict(fix))
+
+
+class FunnelTripTracker:
+    """
+    Stands for the TripTracker in a worker process: trips of every
+    device are tracked (and served) by the parent.
+    """
+
+    def __init__(self, funnel):
+        self.funnel = funnel
+
+    def update(self, imei, fixTime, latitude, longitude):
+        self.funnel.put('trip', imei, fixTime, latitude, longitude)
+
+
+def report_metrics(funnel, worker, metrics, interval=METRICS_INTERVAL):
+    """
+    Send a snapshot of the metrics of a worker to the parent every interval
+    seconds, from a background thread.
+    """
+    def report():
+        while (True):
+            funnel.put('metrics', worker, metrics.snapshot())
+            time.sleep(interval)
+    threading.Thread(target=report, name='MetricsReport', daemon=True).start()
+
+
+def drain(queue, logWriter, positionWriter, liveTable, tripTracker, workerMetrics):
+    """
+    Parent side: write the batches sent by the workers until a None sentinel.
+    logWriter is a function returning the writer of a log file.
+    """
+    while (True):
+        items = queue.get()
+        if (items is None):
+            return
+        for kind, args in items:
+            if (kind == 'log'):
+                logWriter(args[0]).write(args[1])
+            elif (kind == 'fix'):
+                positionWriter.append(*args)
+            elif (kind == 'fixes'):
+                positionWriter.write_array(*args)
+            elif (kind == 'live'):
+                liveTable.publish(*args)
+            elif (kind == 'trip'):
+                tripTracker.update(*args)
+            elif (kind == 'metrics'):
+                workerMetrics.update(*args)
+
+
+def default_workers():
+    return(os.cpu_count() or 1)